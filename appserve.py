@@ -2,24 +2,27 @@
 # -*- coding: utf-8 -*-
 
 import os
+import gc
 import sys
 import json
+import time
 import queue
+import decimal
+import signal
+import socket
 import tempfile
 import threading
+import itertools
 import traceback
 import subprocess
 import collections
 
-from vendor import zhutil
-from vendor import zhconv
-from vendor import figchar
-from vendor import simpleime
+from vendor import appipc
+from vendor import fparser
 from vendor import mosesproxy
-from vendor import chinesename
-#from vendor import fparser
+# the rest are imported by the loaders below
 
-# {"id": 1, "cmd": "bf", "args": [",[.,]", "asdasdf"]}
+# {"id": 1, "cmd": "bf", "args": [",[.,]", "asdasdf"]}, see vendor/appipc.py
 
 def docommands():
     global MSG_Q
@@ -29,9 +32,368 @@ def docommands():
         thr.daemon = True
         thr.start()
 
+def writeresult(obj):
+    with OUT_LCK:
+        appipc.writeframe(OUT, obj)
+
 def async_command(obj):
-    sys.stdout.buffer.write(json.dumps(process(obj)).encode('utf-8') + b'\n')
-    sys.stdout.flush()
+    RUNNING.add(obj['id'])
+    try:
+        writeresult(process(obj))
+    finally:
+        RUNNING.discard(obj['id'])
+
+def health(obj):
+    ret = {'pid': os.getpid(), 'uptime': time.time() - START_TIME, 'queued': MSG_Q.qsize(), 'running': len(RUNNING), 'loaded': dict(LOAD_TIME)}
+    if WORKERS:
+        ret['workers'] = [w.status() for w in WORKERS]
+    return {'id': obj['id'], 'ret': ret, 'exc': None}
+
+def readcommands(fin, dispatch):
+    upd = appipc.readframe(fin)
+    while upd is not None:
+        if upd['cmd'] == appipc.PING:
+            writeresult(health(upd))
+        else:
+            dispatch(upd)
+        upd = appipc.readframe(fin)
+
+def startthreads(group=None):
+    cmdthr = threading.Thread(target=docommands)
+    cmdthr.daemon = True
+    cmdthr.start()
+    if WARMUP:
+        warmthr = threading.Thread(target=warmup, args=(group or COMMANDS,))
+        warmthr.daemon = True
+        warmthr.start()
+
+### Models, loaded on first use by need() or in the background by warmup()
+
+def load_calc():
+    global fx233es
+    fx233es = fparser.Parser(numtype='decimal')
+    # see vendor/fparser.py fuzz
+    fx233es.maxops = 100000
+    fx233es.maxtime = 1
+    fx233es.maxdigits = 1000
+
+def load_zhconv():
+    global zhconv
+    from vendor import zhconv
+
+def load_name():
+    global namemodel
+    from vendor import chinesename
+    namemodel = chinesename.NameModel('vendor/namemodel.m')
+
+def load_ime():
+    global simpleime
+    from vendor import simpleime
+    simpleime.loaddict('vendor/pyindex.dawg', 'vendor/essay.dawg')
+
+def load_fig():
+    global fcgen
+    from vendor import figchar
+    # vendor/wqy.font is made by vendor/convertbdf.py; wqy.pkl is the old format
+    fcgen = figchar.BlockGenerator('vendor/wqy.font' if os.path.isfile('vendor/wqy.font') else 'vendor/wqy.pkl', '🌝🌚')
+
+def load_zhutil():
+    global zhutil
+    from vendor import zhutil
+    zhutil.loadtxtmodel()
+
+def load_say():
+    global SAY_P
+    SAY_P = subprocess.Popen(SAY_CMD, stdin=subprocess.PIPE, stdout=subprocess.PIPE, cwd='vendor')
+    saythr = threading.Thread(target=getsaying)
+    saythr.daemon = True
+    saythr.start()
+
+def need(*names):
+    '''Loads the named components once, recording the time in LOAD_TIME.'''
+    for name in names:
+        if name in LOAD_TIME:
+            continue
+        with LOAD_LCK[name]:
+            if name in LOAD_TIME:
+                continue
+            start = time.perf_counter()
+            LOADERS[name]()
+            LOAD_TIME[name] = time.perf_counter() - start
+
+def warmup(cmds):
+    start = time.perf_counter()
+    for cmd in cmds:
+        try:
+            need(*REQUIRES.get(cmd, ()))
+        except Exception:
+            traceback.print_exc()
+    sys.stderr.write('appserve %d warmed up in %.3fs: %s\n' % (os.getpid(),
+        time.perf_counter() - start, ', '.join('%s %.3fs' % kv for kv in LOAD_TIME.items())))
+    sys.stderr.flush()
+
+def runworker(group, rfd, wfd):
+    '''
+    Entry point of a forked worker. Only touches objects created after fork.
+    '''
+    global OUT, OUT_LCK, MSG_Q, SAY_LCK, RUNNING, START_TIME, WORKERS
+    for w in WORKERS:
+        w.closefds()
+    WORKERS = ()
+    os.dup2(rfd, 0)
+    os.dup2(wfd, 1)
+    os.close(rfd)
+    os.close(wfd)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    OUT = os.fdopen(1, 'wb')
+    OUT_LCK = threading.Lock()
+    MSG_Q = queue.Queue()
+    SAY_LCK = threading.Lock()
+    RUNNING = set()
+    START_TIME = time.time()
+    startthreads(group)
+    try:
+        readcommands(os.fdopen(0, 'rb'), MSG_Q.put)
+    finally:
+        if SAY_P:
+            SAY_P.terminate()
+
+class ForkServer:
+    '''
+    A child forked while appserve.py has no other threads. It loads the
+    components in `preload`, then forks every worker on request, so no
+    fork happens in a process with threads and the workers share the
+    preloaded pages copy-on-write. The workers are its children: it
+    reaps them, and kills them when appserve.py closes the socket.
+    '''
+    def __init__(self, preload):
+        self.sock, child = socket.socketpair()
+        self.lock = threading.Lock()
+        self.pid = os.fork()
+        if self.pid == 0:
+            self.sock.close()
+            try:
+                self.serve(child, preload)
+            finally:
+                os._exit(0)
+        child.close()
+
+    def serve(self, sock, preload):
+        children = set()
+
+        def reap(signum, frame):
+            while children:
+                try:
+                    pid, status = os.waitpid(-1, os.WNOHANG)
+                except ChildProcessError:
+                    break
+                if not pid:
+                    break
+                children.discard(pid)
+
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGCHLD, reap)
+        for name in preload:
+            try:
+                need(name)
+            except Exception:
+                traceback.print_exc()
+        gc.collect()
+        gc.freeze()
+        while 1:
+            msg, fds, flags, addr = socket.recv_fds(sock, 32, 2)
+            if not msg:
+                break
+            signal.pthread_sigmask(signal.SIG_BLOCK, (signal.SIGCHLD,))
+            pid = os.fork()
+            if pid == 0:
+                sock.close()
+                signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                signal.pthread_sigmask(signal.SIG_UNBLOCK, (signal.SIGCHLD,))
+                try:
+                    runworker(WORKERS[int(msg)].group, fds[0], fds[1])
+                finally:
+                    os._exit(0)
+            children.add(pid)
+            signal.pthread_sigmask(signal.SIG_UNBLOCK, (signal.SIGCHLD,))
+            for fd in fds:
+                os.close(fd)
+            sock.sendall(b'%d' % pid)
+        # not reaped while blocked, so no pid here is reused
+        signal.pthread_sigmask(signal.SIG_BLOCK, (signal.SIGCHLD,))
+        for pid in children:
+            os.kill(pid, signal.SIGKILL)
+        for pid in children:
+            os.waitpid(pid, 0)
+
+    def fork(self, index, rfd, wfd):
+        '''Starts WORKERS[index] on the pipe ends `rfd`, `wfd`. Returns its pid.'''
+        with self.lock:
+            try:
+                socket.send_fds(self.sock, [b'%d' % index], [rfd, wfd])
+                return int(self.sock.recv(32))
+            except (OSError, ValueError):
+                # chatdig.py restarts all of appserve.py
+                sys.stderr.write('appserve fork server died\n')
+                os.kill(os.getpid(), signal.SIGTERM)
+                raise
+
+    def stop(self):
+        # it kills the workers on EOF
+        self.sock.close()
+        try:
+            os.waitpid(self.pid, 0)
+        except ChildProcessError:
+            pass
+
+def preloads(groups):
+    '''Components needed by more than one group, worth sharing.'''
+    count = collections.Counter(name for g in groups for name in
+                                frozenset(n for cmd in g for n in REQUIRES.get(cmd, ())))
+    # say starts a thread and a subprocess
+    return [name for name in LOADERS if count[name] > 1 and name != 'say']
+
+class Worker:
+    '''
+    An appserve.py process serving one command group, forked by
+    FORKSERVER.
+    '''
+    def __init__(self, index, group):
+        self.index = index
+        self.group = group
+        self.pid = None
+        self.stdin = self.stdout = None
+        # task id -> [frame, restarts]
+        self.pending = {}
+        self.pings = set()
+        self.pong = self.started = time.time()
+        self.restarts = -1
+        # last health() of the worker
+        self.health = {}
+        self.lock = threading.Lock()
+
+    def closefds(self):
+        # raw close: never flush another process' buffers
+        for f in (self.stdin, self.stdout):
+            try:
+                os.close(f.fileno())
+            except (AttributeError, ValueError, OSError):
+                pass
+
+    def start(self):
+        '''Starts the worker and replays pending tasks. Hold self.lock.'''
+        rin, win = os.pipe()
+        rout, wout = os.pipe()
+        try:
+            pid = FORKSERVER.fork(self.index, rin, wout)
+        finally:
+            os.close(rin)
+            os.close(wout)
+        self.pid = pid
+        self.stdin = os.fdopen(win, 'wb')
+        self.stdout = os.fdopen(rout, 'rb')
+        self.pong = self.started = time.time()
+        self.restarts += 1
+        self.pings.clear()
+        self.health = {}
+        for tid in sorted(self.pending):
+            task = self.pending[tid]
+            task[1] += 1
+            if task[1] > WORKER_RETRY:
+                del self.pending[tid]
+                writeresult({'id': tid, 'ret': 'Server error.', 'exc': 'Worker for %r died %s times.' % (task[0]['cmd'], WORKER_RETRY)})
+            else:
+                self.write(task[0])
+
+    def write(self, obj):
+        try:
+            appipc.writeframe(self.stdin, obj)
+        except (BrokenPipeError, OSError):
+            # monitor() gets EOF and restarts it
+            self.kill()
+
+    def send(self, obj):
+        with self.lock:
+            self.pending[obj['id']] = [obj, 0]
+            self.write(obj)
+
+    def ping(self):
+        with self.lock:
+            if time.time() - self.pong > WORKER_HEARTBEAT * 3:
+                self.kill()
+                return
+            tid = next(PING_SEQ)
+            self.pings.add(tid)
+            self.write({'cmd': appipc.PING, 'args': (), 'id': tid})
+
+    def kill(self):
+        try:
+            os.kill(self.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+    def monitor(self):
+        while 1:
+            obj = appipc.readframe(self.stdout)
+            if obj is None:
+                with self.lock:
+                    if STOPPED:
+                        return
+                    # reaped by the fork server
+                    self.kill()
+                    self.stdin.close()
+                    self.stdout.close()
+                    self.start()
+                continue
+            self.pong = time.time()
+            if obj['id'] in self.pings:
+                self.pings.discard(obj['id'])
+                self.health = obj['ret']
+                continue
+            with self.lock:
+                self.pending.pop(obj['id'], None)
+            writeresult(obj)
+
+    def status(self):
+        return {'pid': self.pid, 'group': self.group, 'pending': len(self.pending),
+                'uptime': time.time() - self.started, 'restarts': self.restarts,
+                'loaded': self.health.get('loaded')}
+
+def startworkers(groups, preload):
+    global WORKERS, FORKSERVER
+    WORKERS = [Worker(i, g) for i, g in enumerate(groups)]
+    for w in WORKERS:
+        for cmd in w.group:
+            ROUTE[cmd] = w
+    # before any thread is started
+    FORKSERVER = ForkServer(preload)
+    for w in WORKERS:
+        with w.lock:
+            w.start()
+    for w in WORKERS:
+        thr = threading.Thread(target=w.monitor)
+        thr.daemon = True
+        thr.start()
+    thr = threading.Thread(target=pingworkers)
+    thr.daemon = True
+    thr.start()
+
+def pingworkers():
+    while 1:
+        time.sleep(WORKER_HEARTBEAT)
+        for w in WORKERS:
+            w.ping()
+
+def dispatch(obj):
+    ROUTE.get(obj['cmd'], WORKERS[0]).send(obj)
+
+def stopworkers():
+    global STOPPED
+    STOPPED = True
+    for w in WORKERS:
+        with w.lock:
+            w.kill()
+    FORKSERVER.stop()
 
 def getsaying():
     global SAY_P, SAY_Q
@@ -57,6 +419,7 @@ def getsayingbytext(text=''):
 def process(obj):
     ret, exc = None, None
     try:
+        need(*REQUIRES.get(obj['cmd'], ()))
         ret = COMMANDS[obj['cmd']](*obj['args'])
     except Exception:
         exc = traceback.format_exc()
@@ -64,13 +427,14 @@ def process(obj):
 
 def cmd_calc(expr):
     '''/calc <expr> Calculate <expr>.'''
-    # Too many bugs
-    r = fx233es.Evaluate(expr)
-    res = None
-    if r is not None or fx233es.rformat:
-        res = fx233es.PrintResult()
-        if len(res) > 200:
-            res = res[:200] + '...'
+    # the decimal context is per thread
+    with CALC_LCK, decimal.localcontext(fparser.decctx_canonfsga):
+        r = fx233es.Evaluate(expr)
+        res = None
+        if r is not None or fx233es.rformat:
+            res = fx233es.PrintResult()
+    if res and len(res) > 200:
+        res = res[:200] + '...'
     return res or 'Nothing'
 
 def cmd_py(expr):
@@ -190,33 +554,95 @@ COMMANDS = collections.OrderedDict((
 ('reply', cmd_reply)
 ))
 
+START_TIME = time.time()
+RUNNING = set()
 MSG_Q = queue.Queue()
+OUT = sys.stdout.buffer
+OUT_LCK = threading.Lock()
 SAY_Q = queue.Queue(maxsize=50)
 SAY_LCK = threading.Lock()
+CALC_LCK = threading.Lock()
 
 SAY_CMD = ('python3', 'say.py', 'chat.binlm', 'chatdict.txt', 'context.pkl')
-SAY_P = subprocess.Popen(SAY_CMD, stdin=subprocess.PIPE, stdout=subprocess.PIPE, cwd='vendor')
+SAY_P = None
 
 EVIL_CMD = ('python', 'seccomp.py')
 BF_CMD = ('vendor/brainfuck',)
 LISP_CMD = ('python', 'lispy.py')
 
-cmdthr = threading.Thread(target=docommands)
-cmdthr.daemon = True
-cmdthr.start()
-
-saythr = threading.Thread(target=getsaying)
-saythr.daemon = True
-saythr.start()
-
-# fx233es = fparser.Parser(numtype='decimal')
-namemodel = chinesename.NameModel('vendor/namemodel.m')
-simpleime.loaddict('vendor/pyindex.dawg', 'vendor/essay.dawg')
-fcgen = figchar.BlockGenerator('vendor/wqy.pkl', '🌝🌚')
-
-try:
-    for ln in sys.stdin.buffer:
-        upd = json.loads(ln.decode('utf-8'))
-        MSG_Q.put(upd)
-finally:
-    SAY_P.terminate()
+# name -> loader, in warm-up order
+LOADERS = collections.OrderedDict((
+('calc', load_calc),
+('zhconv', load_zhconv),
+('fig', load_fig),
+('ime', load_ime),
+('zhutil', load_zhutil),
+('say', load_say),
+('name', load_name)
+))
+# command -> components it needs
+REQUIRES = {
+    'calc': ('calc',),
+    'name': ('name',),
+    'ime': ('zhconv', 'ime'),
+    'fig': ('fig',),
+    'cc': ('zhconv',),
+    'wyw': ('zhutil',),
+    'say': ('zhconv', 'say'),
+    'reply': ('zhconv', 'say')
+}
+LOAD_LCK = {name: threading.Lock() for name in LOADERS}
+# name -> seconds taken to load
+LOAD_TIME = collections.OrderedDict()
+fx233es = zhconv = namemodel = simpleime = fcgen = zhutil = None
+# load everything in the background after startup ("appwarmup" in config.json)
+WARMUP = True
+
+# One forked worker per command group; commands not listed go to the
+# first one. Set "appworkers" in config.json, [] to run in one process.
+WORKER_GROUPS = (
+    ('name', 'ime', 'fig', 'cc'),
+    ('calc', 'py', 'bf', 'lisp'),
+    ('wyw', 'cut', 'say', 'reply')
+)
+WORKER_HEARTBEAT = 10
+WORKER_RETRY = 2
+WORKERS = ()
+FORKSERVER = None
+# set by stopworkers(), when dead workers are not restarted
+STOPPED = False
+# components the fork server loads before forking workers ("apppreload"
+# in config.json), default preloads(WORKER_GROUPS)
+PRELOAD = None
+ROUTE = {}
+PING_SEQ = itertools.count(-1, -1)
+
+def main():
+    global WORKER_GROUPS, WARMUP, PRELOAD
+    try:
+        cfg = json.load(open('config.json'))
+        WORKER_GROUPS = cfg.get('appworkers', WORKER_GROUPS)
+        WARMUP = cfg.get('appwarmup', WARMUP)
+        PRELOAD = cfg.get('apppreload', PRELOAD)
+    except FileNotFoundError:
+        pass
+    if WORKER_GROUPS:
+        # shared models are loaded by the fork server, the rest by the
+        # workers that use them; the parent only answers pings and
+        # routes tasks
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        startworkers(WORKER_GROUPS, preloads(WORKER_GROUPS) if PRELOAD is None else PRELOAD)
+        try:
+            readcommands(sys.stdin.buffer, dispatch)
+        finally:
+            stopworkers()
+    else:
+        startthreads()
+        try:
+            readcommands(sys.stdin.buffer, MSG_Q.put)
+        finally:
+            if SAY_P:
+                SAY_P.terminate()
+
+if __name__ == '__main__':
+    main()
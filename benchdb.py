@@ -0,0 +1,409 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Synthetic chatlog.db files and timings of the queries behind the heavy
+commands.
+
+    python3 benchdb.py gen chatlog-1m.db 1000000 [--days 365] [--users N]
+    python3 benchdb.py bench chatlog-1m.db [...] [-r 5] [-k search,stat]
+    python3 benchdb.py bench 10k 1m 10m [--dir /tmp]
+
+Generated logs have Zipfian user activity, a daily activity curve,
+mixed CJK/English text, replies, forwards, media JSON, joins and IRC
+relay rows, in the schema of chatdig.py. The benchmarks call the
+commands of chatdig.py (/search, /stat, /uinfo, /quote, /context) and
+the fetch methods of digest.py's DigestComposer and StatComposer on a
+scratch copy of the DB, so the input is never modified. A size such as
+1m is generated once as benchdb-1m.db in --dir. Results go to
+benchmark-results.jsonl like those of benchmark.py.
+'''
+
+import os
+import re
+import sys
+import json
+import time
+import random
+import shutil
+import sqlite3
+import argparse
+import tempfile
+import importlib
+import itertools
+import statistics
+import collections
+
+from vendor import sqlbulk
+from vendor import mediacols
+import benchmark
+
+SCHEMA = (
+'''CREATE TABLE IF NOT EXISTS messages (
+id INTEGER PRIMARY KEY,
+src INTEGER,
+text TEXT,
+media TEXT,
+date INTEGER,
+fwd_src INTEGER,
+fwd_date INTEGER,
+reply_id INTEGER,
+media_type INTEGER,
+irc_user TEXT,
+service TEXT
+)''',
+'''CREATE TABLE IF NOT EXISTS users (
+id INTEGER PRIMARY KEY,
+username TEXT,
+first_name TEXT,
+last_name TEXT
+)''',
+'CREATE TABLE IF NOT EXISTS config (id INTEGER PRIMARY KEY, val INTEGER)',
+'''CREATE TABLE IF NOT EXISTS attribution (
+id INTEGER PRIMARY KEY,
+name TEXT,
+ircnick TEXT
+)''')
+
+BOTID = 100
+IRCBOTID = 101
+IRCOFFSET = -1000000
+TIMEZONE = 8 * 3600
+
+# relative activity by local hour
+DIURNAL = (6, 4, 2, 1, 1, 1, 1, 2, 4, 6, 8, 9, 9, 9, 8, 8, 8, 9, 10, 11, 12, 12, 11, 9)
+
+# fraction of rows, the rest are plain text from users
+KINDS = (
+    ('irc', .06),
+    ('media', .08),
+    ('forward', .03),
+    ('reply', .10),
+    ('command', .02),
+    ('service', .002),
+)
+
+MEDIA = (
+    (40, 'photo', lambda r: [{'file_id': 'p%x' % r.getrandbits(48), 'width': w, 'height': w * 3 // 4, 'file_size': r.randint(5000, 200000)} for w in (90, 320, 800)]),
+    (35, 'sticker', lambda r: {'file_id': 's%x' % r.randint(1, 500), 'width': 512, 'height': 512, 'thumb': {'file_id': 't%x' % r.randint(1, 500), 'width': 128, 'height': 128}}),
+    (10, 'document', lambda r: {'file_id': 'd%x' % r.getrandbits(48), 'file_name': 'file%d.pdf' % r.randint(1, 999), 'mime_type': 'application/pdf', 'file_size': r.randint(10 ** 4, 10 ** 7)}),
+    (5, 'video', lambda r: {'file_id': 'v%x' % r.getrandbits(48), 'width': 640, 'height': 360, 'duration': r.randint(1, 300)}),
+    (5, 'voice', lambda r: {'file_id': 'o%x' % r.getrandbits(48), 'duration': r.randint(1, 60), 'mime_type': 'audio/ogg'}),
+    (3, 'audio', lambda r: {'file_id': 'a%x' % r.getrandbits(48), 'duration': r.randint(60, 400), 'mime_type': 'audio/mpeg'}),
+    (2, 'location', lambda r: {'latitude': r.uniform(-90, 90), 'longitude': r.uniform(-180, 180)}),
+)
+
+HANZI = ('的一是了我不人在他有这个上们来到时大地为子中你说生国年着就那和要她出也得里后自以会家可下而过天去能对小多然于心学么之都好看起发当没成只如事把还用第样道想作种开美总从无情己面最女但现前些所同日手又行意动方期它头经长儿回位分爱老因很给名法间斯知世什两次使身者被高已亲其进此话常与活正感'
+         '见明问力理尔点文几定本公特做外孩相西果走将月十实向声车全信重三机工物气每并别真打太新比才便夫再书部水像眼等体却加电主界门利海受听表德少克代员许稜先口由死安写性马光白或住难望教命花结乐色')
+ENGLISH = ('the be to of and a in that have it for not on with he as you do at this but his by from they we say her she or an will my '
+           'one all would there their what so up out if about who get which go me when make can like time no just him know take '
+           'python linux bot telegram irc sqlite lol orz 233 ok thanks emm gcc rust vim emacs').split()
+
+
+def zipfweights(n, s=1.1):
+    return list(itertools.accumulate(1 / (k ** s) for k in range(1, n + 1)))
+
+
+def makevocab(rnd, size=20000):
+    '''Chinese words of 1-4 characters.'''
+    words = set()
+    while len(words) < size:
+        words.add(''.join(rnd.choice(HANZI) for k in range(rnd.choice((1, 2, 2, 2, 3, 4)))))
+    words = list(words)
+    rnd.shuffle(words)
+    return words
+
+
+def maketexts(rnd, number=100000):
+    '''
+    A pool of message texts: word frequencies are Zipfian, lengths
+    roughly log-normal, and a third of the lines mix in English.
+    '''
+    vocab = makevocab(rnd)
+    vw = zipfweights(len(vocab))
+    ew = zipfweights(len(ENGLISH))
+    texts = []
+    for i in range(number):
+        n = max(1, min(int(rnd.lognormvariate(1.6, .8)), 120))
+        r = rnd.random()
+        if r < .55:
+            texts.append(''.join(rnd.choices(vocab, cum_weights=vw, k=n)))
+        elif r < .75:
+            texts.append(' '.join(rnd.choices(ENGLISH, cum_weights=ew, k=n)))
+        else:
+            w = rnd.choices(vocab, cum_weights=vw, k=n)
+            w[rnd.randrange(n)] = ' %s ' % rnd.choice(ENGLISH)
+            texts.append(''.join(w).strip())
+        if rnd.random() < .03:
+            texts[-1] += ' https://example.com/%x' % rnd.getrandbits(32)
+        elif rnd.random() < .02:
+            texts[-1] = '#%s %s' % (rnd.choice(vocab), texts[-1])
+    return texts
+
+
+def makeusers(rnd, number):
+    users = [(BOTID, 'benchbot', 'Bench', None), (IRCBOTID, 'orzirc_bot', 'OrzIRC', None)]
+    for i in range(number):
+        first = rnd.choice(('Alice', 'Bob', 'Carol', 'Dave', 'Eve', '小明', '小红', '阿强', 'Foo', 'Bar')) + str(i)
+        users.append((1000 + i, 'user%d' % i if rnd.random() < .8 else None,
+                      first, rnd.choice(('Smith', 'Wang', '李', None, None))))
+    return users
+
+
+def dayplan(rnd, number, days):
+    '''Messages per day, varying +-50% around the mean.'''
+    w = [rnd.uniform(.5, 1.5) for d in range(days)]
+    total = sum(w)
+    plan = [int(number * x / total) for x in w]
+    plan[-1] += number - sum(plan)
+    return plan
+
+
+def genrows(number, days=365, users=None, seed=0, end=None):
+    '''Yields rows of messages ordered by date, and finally the users.'''
+    rnd = random.Random(seed)
+    end = int(end or time.time())
+    users = users or max(50, int(number ** .5))
+    userrows = makeusers(rnd, users)
+    uids = [u[0] for u in userrows[2:]]
+    uw = zipfweights(len(uids))
+    nicks = ['nick%d' % i for i in range(max(10, users // 10))]
+    nw = zipfweights(len(nicks))
+    texts = maketexts(rnd, min(100000, max(1000, number // 5)))
+    kinds = [k for k, p in KINDS] + ['text']
+    kw = list(itertools.accumulate([p for k, p in KINDS] + [1 - sum(p for k, p in KINDS)]))
+    mediaw = list(itertools.accumulate(w for w, k, f in MEDIA))
+    hourw = list(itertools.accumulate(DIURNAL))
+    mid = 0
+    ircid = IRCOFFSET
+    # the bot answers a command with the next message
+    command = None
+    start = (end + TIMEZONE) // 86400 * 86400 - TIMEZONE - (days - 1) * 86400
+    for day, count in enumerate(dayplan(rnd, number, days)):
+        base = start + day * 86400
+        dates = sorted(base + h * 3600 + rnd.randrange(3600)
+                       for h in rnd.choices(range(24), cum_weights=hourw, k=count))
+        srcs = rnd.choices(uids, cum_weights=uw, k=count)
+        for date, kind, src in zip(dates, rnd.choices(kinds, cum_weights=kw, k=count), srcs):
+            date = min(date, end)
+            text, media, fwd_src, fwd_date, reply_id = rnd.choice(texts), None, None, None, None
+            if kind == 'irc' and ircid < 0:
+                ircid += 1
+                yield (ircid - 1, IRCBOTID, text, json.dumps({'_ircuser': rnd.choices(nicks, cum_weights=nw)[0]}), date, None, None, None)
+                continue
+            mid += 1
+            if command:
+                yield (mid, BOTID, text, None, date, None, None, command)
+                command = None
+                continue
+            elif kind == 'media':
+                w, k, f = rnd.choices(MEDIA, cum_weights=mediaw)[0]
+                media = json.dumps({k: f(rnd)})
+                text = text if k == 'photo' and rnd.random() < .2 else ''
+            elif kind == 'forward':
+                fwd_src = rnd.choices(uids, cum_weights=uw)[0]
+                fwd_date = date - rnd.randrange(30 * 86400)
+            elif kind == 'reply' and mid > 1:
+                reply_id = max(1, mid - 1 - int(rnd.expovariate(.1)))
+            elif kind == 'command':
+                text = rnd.choice(('/s ', '/stat', '/uinfo', '/calc 1+', '/m ', '/quote')) + str(rnd.randrange(100))
+                command = mid
+            elif kind == 'service':
+                u = userrows[rnd.randrange(2, len(userrows))]
+                text = ''
+                media = json.dumps({'new_chat_participant': {'id': u[0], 'first_name': u[2], 'username': u[1]}})
+            yield (mid, src, text, media, date, fwd_src, fwd_date, reply_id)
+    yield userrows
+
+
+def generate(filename, number, days=365, users=None, seed=0, end=None):
+    db = sqlite3.connect(filename)
+    for sql in SCHEMA:
+        db.execute(sql)
+    rows = genrows(number, days, users, seed, end)
+    userrows = []
+    def messages():
+        for row in rows:
+            if isinstance(row, list):
+                userrows.extend(row)
+            else:
+                yield row + mediacols.fromjson(row[3])
+    with sqlbulk.bulkmode(db, ('messages', 'users')) as cur:
+        count = sqlbulk.executemany(cur, 'INSERT INTO messages VALUES (?,?,?,?,?,?,?,?, ?,?,?)', messages())
+        cur.executemany('INSERT INTO users VALUES (?,?,?,?)', userrows)
+    db.execute('PRAGMA user_version = %d' % mediacols.SCHEMA_VERSION)
+    db.execute('ANALYZE')
+    db.commit()
+    db.close()
+    return count
+
+### Query paths: the commands of chatdig.py and the fetch methods of
+### digest.py, run on a copy of the DB
+
+# config.json of the scratch directory
+CONFIG = {'token': 'bench', 'botid': BOTID, 'ircbotid': IRCBOTID, 'groupid': 1000001,
+          'timezone': TIMEZONE // 3600, 'archivedir': 'archive'}
+CHATID = -CONFIG['groupid']
+
+
+def discard(*args, **kwargs):
+    pass
+
+
+def load():
+    '''
+    Imports chatdig.py and digest.py for the chatlog.db and config.json
+    of the current directory, with the Bot API calls discarded.
+    '''
+    import chatdig
+    # digest.py opens them when imported
+    if 'digest' in sys.modules:
+        digest = importlib.reload(sys.modules['digest'])
+    else:
+        import digest
+    chatdig.CFG = CONFIG
+    chatdig.sendmsg = chatdig.forward = chatdig.typing = discard
+    chatdig.USER_CACHE = chatdig.LRUCache(20)
+    chatdig.db_getuidbyname.cache_clear()
+    chatdig.db_getmsg.cache_clear()
+    chatdig.initdb('chatlog.db', CONFIG['archivedir'], 1)
+    return chatdig, digest
+
+
+def cases(chatdig, digest, cur):
+    '''[(name, function)] of the query paths, with arguments picked from the DB.'''
+    now, mid = cur.execute('SELECT max(date), max(id) FROM messages').fetchone()
+    # a word from the latest text, and the most active user
+    common = cur.execute("SELECT text FROM messages WHERE text != '' AND text NOT LIKE '/%' ORDER BY id DESC LIMIT 1").fetchone()
+    common = (common[0] if common else 'a')[:2]
+    user = cur.execute('SELECT src, username FROM (SELECT src FROM messages ORDER BY id DESC LIMIT 10000) JOIN users ON users.id = src '
+                       'WHERE username IS NOT NULL GROUP BY src ORDER BY count(*) DESC LIMIT 1').fetchone() or (0, 'nobody')
+    # /stat and /uinfo count back from the current time, not from the
+    # end of the log
+    age = max(int(time.time()) - now, 0) // 60
+    msg = {'from': {'id': user[0]}}
+    cmd = lambda func, expr: lambda: func(expr, CHATID, None, msg)
+    dc = digest.DigestComposer.__new__(digest.DigestComposer)
+    return (
+        ('search_common', cmd(chatdig.cmd_search, common)),
+        ('search_missing', cmd(chatdig.cmd_search, 'no-such-text')),
+        ('search_user', cmd(chatdig.cmd_search, '@' + user[1])),
+        ('stat_1d', cmd(chatdig.cmd_stat, str(1440 + age))),
+        ('stat_30d', cmd(chatdig.cmd_stat, str(43200 + age))),
+        ('uinfo_1d', cmd(chatdig.cmd_uinfo, str(1440 + age))),
+        # today's message, or any if the log ends before today
+        ('quote', cmd(chatdig.cmd_quote, '')),
+        ('context', cmd(chatdig.cmd_context, '%d 10' % (mid // 2))),
+        # without the models loaded by DigestComposer()
+        ('digest_fetch', lambda: dc.fetchmsg(now - 86400)),
+        ('stat_page', digest.StatComposer().fetchmsgstat),
+    )
+
+
+def bench(filename, repeat=5, budget=30, keys=None):
+    '''
+    Runs each case up to `repeat` times, stopping early after `budget`
+    seconds. Returns {case: {'min', 'median', 'runs'}} in seconds.
+
+    The cases run in a scratch directory on a copy of `filename`, which
+    chatdig.py upgrades and indexes as at startup.
+    '''
+    workdir = tempfile.mkdtemp(prefix='benchdb-')
+    cwd = os.getcwd()
+    src = sqlite3.connect(filename)
+    db = sqlite3.connect(os.path.join(workdir, 'chatlog.db'))
+    src.backup(db)
+    src.close()
+    os.symlink(os.path.join(benchmark.ROOT, 'vendor'), os.path.join(workdir, 'vendor'))
+    with open(os.path.join(workdir, 'config.json'), 'w') as f:
+        json.dump(CONFIG, f)
+    os.chdir(workdir)
+    try:
+        chatdig, digest = load()
+        rows = db.execute('SELECT count(*) FROM messages').fetchone()[0]
+        results = collections.OrderedDict()
+        for name, func in cases(chatdig, digest, db.cursor()):
+            if keys and not any(name.startswith(k) for k in keys):
+                continue
+            times = []
+            while len(times) < repeat and sum(times) < budget:
+                start = time.perf_counter()
+                func()
+                times.append(time.perf_counter() - start)
+            results[name] = {'min': min(times), 'median': statistics.median(times), 'runs': len(times)}
+        chatdig.DB.close()
+        digest.db.close()
+    finally:
+        db.close()
+        os.chdir(cwd)
+        shutil.rmtree(workdir)
+    return rows, results
+
+
+SIZES = {'k': 10 ** 3, 'm': 10 ** 6}
+
+
+def parsesize(s):
+    m = re.match(r'^(\d+)([km]?)$', s.lower())
+    if m:
+        return int(m.group(1)) * SIZES.get(m.group(2), 1)
+
+
+def printresults(record, previous=None):
+    print('%s: %d rows, commit %s%s' % (record['params']['db'], record['result']['rows'], record['commit'],
+                                       '  vs %s (%s)' % (previous['commit'], previous['date']) if previous else ''))
+    for name, r in record['result']['cases'].items():
+        line = '  %-16s %10.2f ms' % (name, r['median'] * 1000)
+        old = previous and previous['result']['cases'].get(name)
+        if old:
+            line += ' %10.2f ms %+7.1f%%' % (old['median'] * 1000, (r['median'] - old['median']) / old['median'] * 100)
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate chatlog.db files and time the queries of the heavy commands.')
+    sub = parser.add_subparsers(dest='action')
+    p = sub.add_parser('gen', help='generate a chatlog.db')
+    p.add_argument('file')
+    p.add_argument('number', help='number of messages, e.g. 10000 or 1m')
+    p.add_argument('--days', type=int, default=365)
+    p.add_argument('--users', type=int, help='default: sqrt(number), at least 50')
+    p.add_argument('--seed', type=int, default=0)
+    p = sub.add_parser('bench', help='time the query paths')
+    p.add_argument('dbs', nargs='+', help='chatlog.db files, or sizes like 10k 1m 10m')
+    p.add_argument('--dir', default='.', help='where generated benchdb-<size>.db files are kept')
+    p.add_argument('-r', '--repeat', type=int, default=5)
+    p.add_argument('-b', '--budget', type=float, default=30, help='seconds per case')
+    p.add_argument('-k', '--keys', help='comma separated case name prefixes')
+    p.add_argument('--no-save', action='store_true')
+    args = parser.parse_args()
+    if args.action == 'gen':
+        start = time.perf_counter()
+        count = generate(args.file, parsesize(args.number), args.days, args.users, args.seed)
+        print('%d messages in %.1fs' % (count, time.perf_counter() - start))
+    elif args.action == 'bench':
+        for fn in args.dbs:
+            size = parsesize(fn)
+            if not os.path.isfile(fn) and size:
+                name = os.path.join(args.dir, 'benchdb-%s.db' % fn.lower())
+                if not os.path.isfile(name):
+                    start = time.perf_counter()
+                    generate(name + '.part', size)
+                    os.rename(name + '.part', name)
+                    print('generated %s in %.1fs' % (name, time.perf_counter() - start))
+                fn = name
+            rows, cases = bench(fn, args.repeat, args.budget, args.keys and args.keys.split(','))
+            params = {'suite': 'queries', 'db': os.path.basename(fn)}
+            previous = benchmark.loadresults(params)
+            record = {'commit': benchmark.gitcommit(), 'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+                      'params': params, 'result': {'rows': rows, 'cases': cases}}
+            printresults(record, previous[-1] if previous else None)
+            if not args.no_save:
+                with open(benchmark.RESULTS, 'a', encoding='utf-8') as f:
+                    f.write(json.dumps(record, sort_keys=True) + '\n')
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,439 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+End-to-end benchmark of chatdig.py against a local fake Bot API.
+
+    python3 benchmark.py [-n 5000] [-r 0] [--replay updates.jsonl] [--db chatlog.db]
+
+This starts a fake Bot API server (getUpdates, sendMessage,
+forwardMessage, sendChatAction). It then runs chatdig.py in a scratch
+directory, with `python3 benchmark.py appserve` as the app server.
+Updates are released at --rate per second, or all at once for 0. They
+go through the real getUpdates -> processmsg -> logmsg path.
+
+Reported:
+- messages/s: all updates processed, timed from the first release
+- command latency: from release (e2e) and from delivery in a
+  getUpdates response (bot) to the first reply
+- DB writes: write_bytes of chatdig.py in /proc/pid/io, after a
+  SIGUSR1 commit, divided by the bytes of message text logged
+- peak RSS
+Each run is appended to benchmark-results.jsonl with the git commit.
+The previous run with the same parameters is shown next to it.
+'''
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import signal
+import socket
+import argparse
+import tempfile
+import itertools
+import threading
+import subprocess
+import collections
+import http.server
+import urllib.parse
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+RESULTS = os.path.join(ROOT, 'benchmark-results.jsonl')
+
+BOTID = 100
+GROUPID = 1000001
+TOKEN = 'bench'
+BOTNAME = 'benchbot'
+
+# (weight, command text) for synthetic command messages; {mid} is a
+# random earlier message id
+COMMAND_MIX = (
+    (4, '/s {word}'),
+    (2, '/stat'),
+    (2, '/uinfo'),
+    (3, '/calc {mid}*3+1'),
+    (2, '/233 {n}'),
+    (2, '/context {mid}'),
+)
+
+WORDS = ('的 一 是 了 我 不 人 在 他 有 这 个 上 们 来 到 时 大 地 为 子 中 你 说 生 国 年 着 就 那 和 要 她 出 也 得 '
+         'hello world python telegram bot sqlite test ok lol 233 orz').split()
+
+### Fake Bot API
+
+
+class FakeBotAPI(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, updates, rate):
+        super().__init__(('127.0.0.1', 0), FakeBotHandler)
+        self.updates = updates
+        self.firstid = updates[0]['update_id'] if updates else 0
+        self.rate = rate
+        self.start = None
+        self.cond = threading.Condition()
+        # index -> time handed out by getUpdates
+        self.delivered = {}
+        # message id replied to -> time of the first reply
+        self.replies = {}
+        self.calls = collections.Counter()
+        self.msgseq = itertools.count(10 ** 9)
+
+    def released(self, now):
+        if self.start is None:
+            return 0
+        elif not self.rate:
+            return len(self.updates)
+        return min(len(self.updates), int((now - self.start) * self.rate) + 1)
+
+    def releasetime(self, index):
+        return self.start + (index / self.rate if self.rate else 0)
+
+    def getupdates(self, offset, timeout, limit):
+        with self.cond:
+            if self.start is None:
+                self.start = time.perf_counter()
+        index = max(offset - self.firstid, 0)
+        deadline = time.perf_counter() + timeout
+        while 1:
+            now = time.perf_counter()
+            avail = self.released(now)
+            if avail > index or now >= deadline:
+                break
+            if self.rate:
+                wait = min(deadline, self.releasetime(avail)) - now
+            else:
+                wait = deadline - now
+            time.sleep(max(min(wait, .05), .001))
+        end = min(avail, index + limit)
+        with self.cond:
+            for i in range(index, end):
+                self.delivered.setdefault(i, now)
+        return self.updates[index:end]
+
+    def message(self, chat_id, **kwargs):
+        chat_id = int(chat_id)
+        if chat_id < 0:
+            chat = {'id': chat_id, 'title': 'bench', 'type': 'group'}
+        else:
+            chat = {'id': chat_id, 'first_name': 'U%d' % chat_id, 'type': 'private'}
+        m = {'message_id': next(self.msgseq), 'date': int(time.time()), 'chat': chat,
+             'from': {'id': BOTID, 'first_name': 'Bench', 'username': BOTNAME}}
+        m.update(kwargs)
+        return m
+
+    def call(self, method, params):
+        self.calls[method] += 1
+        if method == 'getUpdates':
+            return self.getupdates(int(params.get('offset', 0)), float(params.get('timeout', 0)), int(params.get('limit', 100)))
+        elif method == 'sendMessage':
+            rid = params.get('reply_to_message_id')
+            m = self.message(params['chat_id'], text=params.get('text', ''))
+            if rid:
+                m['reply_to_message'] = self.message(params['chat_id'], message_id=int(rid))
+                with self.cond:
+                    self.replies.setdefault(int(rid), time.perf_counter())
+            return m
+        elif method == 'forwardMessage':
+            return self.message(params['chat_id'], text='forwarded', forward_date=int(time.time()),
+                                forward_from={'id': 1000, 'first_name': 'U1000'})
+        elif method == 'sendChatAction':
+            return True
+        raise KeyError(method)
+
+
+class FakeBotHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        params = dict(urllib.parse.parse_qsl(url.query))
+        method = url.path.rsplit('/', 1)[-1]
+        try:
+            ret = {'ok': True, 'result': self.server.call(method, params)}
+        except Exception as ex:
+            ret = {'ok': False, 'error_code': 400, 'description': repr(ex)}
+        body = json.dumps(ret).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_POST = do_GET
+
+    def log_message(self, format, *args):
+        pass
+
+### Update streams
+
+
+def synthupdates(number, seed=0, cmdratio=.08, privratio=.01):
+    rnd = random.Random(seed)
+    users = [{'id': 1000 + i, 'first_name': 'U%d' % i, 'username': 'user%d' % i} for i in range(50)]
+    group = {'id': -GROUPID, 'title': 'bench', 'type': 'group'}
+    now = int(time.time()) - number
+    updates = []
+    for i in range(1, number + 1):
+        user = rnd.choice(users)
+        msg = {'message_id': i, 'from': user, 'chat': group, 'date': now + i}
+        r = rnd.random()
+        if r < privratio:
+            msg['chat'] = dict(user, type='private')
+            msg['text'] = rnd.choice(('/help', '/s %s' % rnd.choice(WORDS), '/233'))
+        elif r < privratio + cmdratio:
+            cmd = rnd.choices([c for w, c in COMMAND_MIX], [w for w, c in COMMAND_MIX])[0]
+            msg['text'] = cmd.format(word=rnd.choice(WORDS), mid=rnd.randint(1, i), n=rnd.randint(1, 20))
+        else:
+            msg['text'] = ''.join(rnd.choice(WORDS) for k in range(rnd.randint(1, 30)))
+            r = rnd.random()
+            if r < .1 and i > 1:
+                rm = rnd.randint(1, i - 1)
+                msg['reply_to_message'] = {'message_id': rm, 'from': rnd.choice(users), 'chat': group, 'date': now + rm}
+            elif r < .13:
+                msg['forward_from'] = rnd.choice(users)
+                msg['forward_date'] = now
+            elif r < .16:
+                del msg['text']
+                msg['sticker'] = {'file_id': 'sticker%d' % rnd.randint(1, 100), 'width': 512, 'height': 512}
+        updates.append({'update_id': i, 'message': msg})
+    return updates
+
+
+def loadupdates(filename):
+    with open(filename, encoding='utf-8') as f:
+        return [json.loads(ln) for ln in f if ln.strip()]
+
+
+def iscommand(msg):
+    text = msg.get('text', '')
+    return text[:1] == '/' or 'first_name' in msg['chat']
+
+### Stub appserve
+
+
+def stubappserve():
+    sys.path.insert(0, ROOT)
+    from vendor import appipc
+    stdin, stdout = sys.stdin.buffer, sys.stdout.buffer
+    obj = appipc.readframe(stdin)
+    while obj is not None:
+        if obj['cmd'] == appipc.PING:
+            appipc.writeframe(stdout, {'id': obj['id'], 'ret': {}, 'exc': None})
+        else:
+            appipc.writeframe(stdout, {'id': obj['id'], 'ret': '%s: %r' % (obj['cmd'], obj['args']), 'exc': None})
+        obj = appipc.readframe(stdin)
+
+### Runner
+
+
+def unixget(path, url):
+    s = socket.socket(socket.AF_UNIX)
+    try:
+        s.settimeout(5)
+        s.connect(path)
+        s.sendall(('GET %s HTTP/1.0\r\n\r\n' % url).encode('ascii'))
+        data = b''.join(iter(lambda: s.recv(65536), b''))
+    finally:
+        s.close()
+    return data.split(b'\r\n\r\n', 1)[1]
+
+
+def procstat(pid):
+    d = {}
+    try:
+        with open('/proc/%d/status' % pid) as f:
+            for ln in f:
+                k, v = ln.split(':', 1)
+                if k in ('VmRSS', 'VmHWM'):
+                    d[k] = int(v.split()[0]) * 1024
+        with open('/proc/%d/io' % pid) as f:
+            for ln in f:
+                k, v = ln.split(':', 1)
+                d[k] = int(v)
+    except OSError:
+        pass
+    return d
+
+
+def percentiles(values):
+    if not values:
+        return None
+    values = sorted(values)
+    pick = lambda q: values[min(int(q * len(values)), len(values) - 1)]
+    return {'n': len(values), 'p50': pick(.5), 'p90': pick(.9), 'p99': pick(.99), 'max': values[-1]}
+
+
+def run(updates, rate, db=None, timeout=120, keep=False):
+    workdir = tempfile.mkdtemp(prefix='chatdig-bench-')
+    server = FakeBotAPI(updates, rate)
+    thr = threading.Thread(target=server.serve_forever)
+    thr.daemon = True
+    thr.start()
+    sock = os.path.join(workdir, 'metrics.sock')
+    cfg = {
+        'token': TOKEN, 'botname': BOTNAME, 'botid': BOTID, 'ircbotid': BOTID + 1,
+        'groupid': GROUPID, 'groupname': 'bench', 'timezone': 8,
+        'apiserver': 'http://127.0.0.1:%d' % server.server_address[1],
+        'appcmd': [sys.executable, os.path.abspath(__file__), 'appserve'],
+        'metrics': sock
+    }
+    with open(os.path.join(workdir, 'config.json'), 'w') as f:
+        json.dump(cfg, f)
+    if db:
+        shutil.copy(db, os.path.join(workdir, 'chatlog.db'))
+    log = open(os.path.join(workdir, 'chatdig.log'), 'wb')
+    proc = subprocess.Popen((sys.executable, os.path.join(ROOT, 'chatdig.py')), cwd=workdir, stdout=log, stderr=subprocess.STDOUT)
+    commands = {u['message']['message_id']: i for i, u in enumerate(updates)
+                if 'message' in u and iscommand(u['message'])}
+    textbytes = sum(len((u['message'].get('text') or '').encode('utf-8'))
+                    for u in updates if 'message' in u)
+    snap = {}
+    done = None
+    try:
+        deadline = time.perf_counter() + timeout
+        while time.perf_counter() < deadline and proc.poll() is None:
+            time.sleep(.02)
+            try:
+                snap = json.loads(unixget(sock, '/json').decode('utf-8'))
+            except (OSError, ValueError, IndexError):
+                continue
+            processed = snap.get('processmsg', {}).get('count', 0) + snap.get('processmsg.errors', 0)
+            if done is None and processed >= len(updates):
+                done = time.perf_counter()
+            if done and len(server.replies.keys() & commands.keys()) >= len(commands):
+                break
+        if proc.poll() is not None:
+            raise RuntimeError('chatdig.py exited, see %s' % log.name)
+        before = procstat(proc.pid)
+        proc.send_signal(signal.SIGUSR1)
+        time.sleep(1)
+        after = procstat(proc.pid)
+    finally:
+        if proc.poll() is None:
+            proc.send_signal(signal.SIGINT)
+            try:
+                proc.wait(10)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+        server.shutdown()
+        log.close()
+    e2e, bot = [], []
+    for mid, i in commands.items():
+        t = server.replies.get(mid)
+        if t is not None:
+            e2e.append((t - server.releasetime(i)) * 1000)
+            bot.append((t - server.delivered[i]) * 1000)
+    elapsed = (done or time.perf_counter()) - server.start
+    writes = after.get('write_bytes', 0)
+    result = {
+        'messages': len(updates),
+        'processed': snap.get('processmsg', {}).get('count', 0),
+        'complete': done is not None,
+        'elapsed': elapsed,
+        'msgs_per_sec': snap.get('processmsg', {}).get('count', 0) / elapsed,
+        'cmd_latency_e2e_ms': percentiles(e2e),
+        'cmd_latency_bot_ms': percentiles(bot),
+        'cmd_unanswered': len(commands) - len(e2e),
+        'db_write_bytes': writes,
+        'db_write_bytes_uncommitted': before.get('write_bytes', 0),
+        'write_amplification': writes / textbytes if textbytes else None,
+        'rss_peak': after.get('VmHWM'),
+        'rss': after.get('VmRSS'),
+        'api_calls': dict(server.calls),
+        'chatdig': {k: v for k, v in snap.items() if isinstance(v, dict) and v.get('count')},
+        'startup': {k[8:]: v for k, v in snap.items() if k.startswith('startup.')},
+    }
+    if keep:
+        result['workdir'] = workdir
+    else:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return result
+
+
+def gitcommit():
+    try:
+        rev = subprocess.check_output(('git', 'rev-parse', '--short', 'HEAD'), cwd=ROOT, stderr=subprocess.DEVNULL).decode().strip()
+        dirty = subprocess.call(('git', 'diff', '--quiet', 'HEAD'), cwd=ROOT, stderr=subprocess.DEVNULL)
+        return rev + ('+' if dirty else '')
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def loadresults(params):
+    if not os.path.isfile(RESULTS):
+        return []
+    with open(RESULTS, encoding='utf-8') as f:
+        return [r for r in map(json.loads, f) if r['params'] == params]
+
+
+SUMMARY = (
+    ('msgs/s', lambda r: r['msgs_per_sec'], '%.1f'),
+    ('cmd e2e p50 ms', lambda r: (r['cmd_latency_e2e_ms'] or {}).get('p50'), '%.1f'),
+    ('cmd e2e p99 ms', lambda r: (r['cmd_latency_e2e_ms'] or {}).get('p99'), '%.1f'),
+    ('cmd bot p50 ms', lambda r: (r['cmd_latency_bot_ms'] or {}).get('p50'), '%.1f'),
+    ('cmd bot p99 ms', lambda r: (r['cmd_latency_bot_ms'] or {}).get('p99'), '%.1f'),
+    ('processmsg p50 ms', lambda r: r['chatdig'].get('processmsg', {}).get('p50', 0) * 1000, '%.3f'),
+    ('processmsg p99 ms', lambda r: r['chatdig'].get('processmsg', {}).get('p99', 0) * 1000, '%.3f'),
+    ('DB write bytes', lambda r: r['db_write_bytes'], '%d'),
+    ('write amplification', lambda r: r['write_amplification'], '%.2f'),
+    ('peak RSS MiB', lambda r: (r['rss_peak'] or 0) / 1048576, '%.1f'),
+    ('startup ms', lambda r: r.get('startup', {}).get('total', 0) * 1000 or None, '%.1f'),
+    ('app ready ms', lambda r: r['chatdig'].get('app.ready', {}).get('max', 0) * 1000 or None, '%.1f'),
+)
+
+
+def printsummary(record, previous=None):
+    print('commit %s%s' % (record['commit'], '  vs %s (%s)' % (previous['commit'], previous['date']) if previous else ''))
+    for name, get, fmt in SUMMARY:
+        cur = get(record['result'])
+        line = '  %-20s %12s' % (name, fmt % cur if cur is not None else '-')
+        if previous:
+            old = get(previous['result'])
+            line += ' %12s' % (fmt % old if old is not None else '-')
+            if cur and old:
+                line += ' %+7.1f%%' % ((cur - old) / old * 100)
+        print(line)
+    r = record['result']
+    if not r['complete'] or r['cmd_unanswered']:
+        print('  incomplete: %d/%d processed, %d commands unanswered' % (r['processed'], r['messages'], r['cmd_unanswered']))
+
+
+def main():
+    if sys.argv[1:2] == ['appserve']:
+        return stubappserve()
+    parser = argparse.ArgumentParser(description='Benchmark chatdig.py against a fake Bot API.')
+    parser.add_argument('-n', '--number', type=int, default=5000, help='number of synthetic updates')
+    parser.add_argument('-r', '--rate', type=float, default=0, help='updates released per second, 0 for all at once')
+    parser.add_argument('-s', '--seed', type=int, default=0, help='seed of the synthetic stream')
+    parser.add_argument('--replay', help='replay updates from a JSON lines file instead')
+    parser.add_argument('--record', help='write the update stream to a JSON lines file and exit')
+    parser.add_argument('--db', help='start from a copy of this chatlog.db')
+    parser.add_argument('--timeout', type=float, default=120)
+    parser.add_argument('--keep', action='store_true', help='keep the scratch directory with the log and DB')
+    parser.add_argument('--no-save', action='store_true', help='do not append to ' + os.path.basename(RESULTS))
+    args = parser.parse_args()
+    updates = loadupdates(args.replay) if args.replay else synthupdates(args.number, args.seed)
+    if args.record:
+        with open(args.record, 'w', encoding='utf-8') as f:
+            for upd in updates:
+                f.write(json.dumps(upd, ensure_ascii=False) + '\n')
+        return
+    params = {'updates': args.replay or 'synth:%d:%d' % (args.number, args.seed),
+              'rate': args.rate, 'db': os.path.basename(args.db) if args.db else None}
+    previous = loadresults(params)
+    record = {'commit': gitcommit(), 'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+              'params': params, 'result': run(updates, args.rate, args.db, args.timeout, args.keep)}
+    printsummary(record, previous[-1] if previous else None)
+    if 'workdir' in record['result']:
+        print('scratch directory: ' + record['result']['workdir'])
+    if not args.no_save:
+        with open(RESULTS, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(record, sort_keys=True) + '\n')
+
+
+if __name__ == '__main__':
+    main()
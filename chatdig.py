@@ -14,11 +14,20 @@ import logging
 import sqlite3
 import threading
 import functools
+import contextlib
+import itertools
 import subprocess
 import collections
 
 import requests
-from vendor import libirc
+from vendor import aioirc
+from vendor import appipc
+from vendor import dbpool
+from vendor import metrics
+from vendor import sqlbulk
+from vendor import threads
+from vendor import timeline
+from vendor import mediacols
 
 __version__ = '1.2'
 
@@ -28,13 +37,41 @@ loglevel = logging.DEBUG if sys.argv[-1] == '-d' else logging.INFO
 
 logging.basicConfig(stream=sys.stdout, format='# %(asctime)s [%(levelname)s] %(message)s', level=loglevel)
 
+METRICS = metrics.Registry()
+PROFILER = metrics.Profiler()
+
 HSession = requests.Session()
 USERAGENT = 'TgChatDiggerBot/%s %s' % (__version__, HSession.headers["User-Agent"])
 HSession.headers["User-Agent"] = USERAGENT
 
-db = sqlite3.connect('chatlog.db')
-conn = db.cursor()
-conn.execute('''CREATE TABLE IF NOT EXISTS messages (
+def initdb(filename='chatlog.db', archivedir='archive', readers=4, days=7):
+    global DB, OFFSET, IRCOFFSET, REPLY_IDX, TIMELINE
+    # one writer, `readers` read-only connections with their own
+    # archive routers, see vendor/dbpool.py and vendor/archive.py
+    DB = dbpool.Pool(filename, readers, archivedir)
+    with DB.write() as conn:
+        initschema(conn)
+        OFFSET = conn.execute('SELECT val FROM config WHERE id = 0').fetchone()
+        OFFSET = OFFSET[0] if OFFSET else 0
+        IRCOFFSET = conn.execute('SELECT val FROM config WHERE id = 1').fetchone()
+        IRCOFFSET = IRCOFFSET[0] if IRCOFFSET else -1000000
+        # typed media columns, filled once for older DBs
+        count = mediacols.upgrade(DB.writer)
+        if count:
+            logging.info('Filled media columns of %d messages.' % count)
+    DB.commit()
+    REPLY_IDX = ReplyIndex(5000, DB)
+    # per-minute counts of the last `days` days, see vendor/timeline.py
+    TIMELINE = timeline.Timeline(DB, days)
+    # reply and forward links, see vendor/threads.py
+    with DB.write() as cur, DB.read() as r:
+        count = threads.setup(cur, r.archive)
+    if count:
+        logging.info('Indexed %d reply and forward links.' % count)
+    DB.commit()
+
+def initschema(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS messages (
 id INTEGER PRIMARY KEY,
 src INTEGER,
 text TEXT,
@@ -42,16 +79,37 @@ media TEXT,
 date INTEGER,
 fwd_src INTEGER,
 fwd_date INTEGER,
-reply_id INTEGER
+reply_id INTEGER,
+media_type INTEGER,
+irc_user TEXT,
+service TEXT
 )''')
-conn.execute('''CREATE TABLE IF NOT EXISTS users (
+    conn.execute('''CREATE TABLE IF NOT EXISTS users (
 id INTEGER PRIMARY KEY,
 username TEXT,
 first_name TEXT,
 last_name TEXT
 )''')
-conn.execute('CREATE TABLE IF NOT EXISTS config (id INTEGER PRIMARY KEY, val INTEGER)')
-# conn.execute('CREATE TABLE IF NOT EXISTS words (word TEXT PRIMARY KEY, count INTEGER)')
+    conn.execute('CREATE TABLE IF NOT EXISTS config (id INTEGER PRIMARY KEY, val INTEGER)')
+    conn.execute('''CREATE TABLE IF NOT EXISTS attribution (
+id INTEGER PRIMARY KEY,
+name TEXT,
+ircnick TEXT
+)''')
+    # conn.execute('CREATE TABLE IF NOT EXISTS words (word TEXT PRIMARY KEY, count INTEGER)')
+
+def loadconfig(filename='config.json'):
+    global CFG, URL, APP_CMD
+    CFG = json.load(open(filename))
+    URL = '%s/bot%s/' % (CFG.get('apiserver', 'https://api.telegram.org'), CFG['token'])
+    APP_CMD = tuple(CFG.get('appcmd', APP_CMD))
+
+@contextlib.contextmanager
+def startup(name):
+    '''Records the time of a startup step as the startup.<name> gauge.'''
+    start = time.perf_counter()
+    yield
+    METRICS.gauge('startup.' + name).set(time.perf_counter() - start)
 
 re_ircaction = re.compile('^\x01ACTION (.*)\x01$')
 re_ircforward = re.compile(r'^\[([^]]+)\] (.*)$|^\*\* ([^ ]+) (.*) \*\*$')
@@ -61,27 +119,84 @@ class LRUCache:
     def __init__(self, maxlen):
         self.capacity = maxlen
         self.cache = collections.OrderedDict()
+        self.lock = threading.Lock()
 
     def __getitem__(self, key):
-        value = self.cache.pop(key)
-        self.cache[key] = value
-        return value
+        with self.lock:
+            self.cache.move_to_end(key)
+            return self.cache[key]
 
     def get(self, key, default=None):
-        try:
-            value = self.cache.pop(key)
-            self.cache[key] = value
-            return value
-        except KeyError:
-            return default
+        with self.lock:
+            try:
+                self.cache.move_to_end(key)
+                return self.cache[key]
+            except KeyError:
+                return default
 
     def __setitem__(self, key, value):
-        try:
-            self.cache.pop(key)
-        except KeyError:
-            if len(self.cache) >= self.capacity:
+        with self.lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+            elif len(self.cache) >= self.capacity:
                 self.cache.popitem(last=False)
-        self.cache[key] = value
+            self.cache[key] = value
+
+class ReplyIndex:
+    '''
+    Message id -> (display name, IRC nick) of group messages, used to
+    attribute replies on IRC. The last `maxlen` entries are in memory;
+    the rest are read from the attribution table, which keeps the last
+    `keep` ids.
+    '''
+
+    def __init__(self, maxlen, pool, keep=100000):
+        self.maxlen = maxlen
+        self.pool = pool
+        self.keep = keep
+        self.cache = {}
+        self.ring = collections.deque()
+        # written by flush() in the main thread
+        self.pending = []
+        self.lock = threading.Lock()
+
+    def add(self, mid, name, ircnick=None):
+        with self.lock:
+            if mid not in self.cache:
+                self.ring.append(mid)
+                if len(self.ring) > self.maxlen:
+                    del self.cache[self.ring.popleft()]
+            self.cache[mid] = (name, ircnick)
+            self.pending.append((mid, name, ircnick))
+        return (name, ircnick)
+
+    def addmsg(self, msg):
+        if '_ircuser' in msg:
+            return self.add(msg['message_id'], msg['_ircuser'], msg['_ircuser'])
+        ircnick = None
+        if msg['from']['id'] in (CFG['botid'], CFG['ircbotid']):
+            rnmatch = re_ircforward.match(msg.get('text', ''))
+            if rnmatch:
+                ircnick = rnmatch.group(1) or rnmatch.group(3)
+        return self.add(msg['message_id'], dc_getufname(msg['from'])[:20], ircnick)
+
+    def get(self, mid):
+        with self.lock:
+            val = self.cache.get(mid)
+        if val:
+            return val
+        return self.pool.fetchone('SELECT name, ircnick FROM attribution WHERE id = ?', (mid,))
+
+    def flush(self):
+        with self.lock:
+            rows, self.pending = self.pending, []
+        if rows:
+            self.pool.executemany('REPLACE INTO attribution (id, name, ircnick) VALUES (?,?,?)', rows)
+            # Telegram ids count up from 1, IRC ids from IRCOFFSET
+            for top in (max((r[0] for r in rows if r[0] > 0), default=None),
+                        max((r[0] for r in rows if r[0] < 0), default=None)):
+                if top is not None:
+                    self.pool.execute('DELETE FROM attribution WHERE id < ? AND (id > 0) = ?', (top - self.keep, top > 0))
 
 def async_func(func):
     @functools.wraps(func)
@@ -111,6 +226,7 @@ def getupdates():
             continue
         if updates:
             logging.debug('Messages coming.')
+            METRICS.counter('updates').inc(len(updates))
             OFFSET = updates[-1]["update_id"] + 1
             for upd in updates:
                 MSG_Q.put(upd)
@@ -119,93 +235,135 @@ def getupdates():
 def checkappproc():
     global APP_P
     if APP_P.poll() is not None:
-        APP_P = subprocess.Popen(APP_CMD, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        restartapp()
+
+def restartapp():
+    '''
+    (Re)starts appserve.py and resends unanswered tasks. Hold APP_LCK.
+    '''
+    global APP_P, APP_PONG, APP_STARTED
+    if APP_STOP:
+        return
+    if APP_P and APP_P.poll() is None:
+        APP_P.terminate()
+    APP_P = subprocess.Popen(APP_CMD, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    APP_PONG = time.time()
+    APP_STARTED = time.perf_counter()
+    APP_PINGS.clear()
+    tid = next(APP_SEQ)
+    APP_PINGS.add(tid)
+    try:
+        appipc.writeframe(APP_P.stdin, {"cmd": appipc.PING, "args": (), "id": tid})
+        for tid in sorted(APP_TASK):
+            task = APP_TASK[tid]
+            task[3] += 1
+            if task[3] > APP_RETRY:
+                del APP_TASK[tid]
+                logging.error('Task %s (%s) dropped after %s restarts.' % (tid, task[0], APP_RETRY))
+                sendmsg('Server error.', task[2][0], task[2][1])
+            else:
+                appipc.writeframe(APP_P.stdin, {"cmd": task[0], "args": task[1], "id": tid})
+    except (BrokenPipeError, OSError):
+        # died again; getappresult() restarts it and replays the rest
+        task = APP_TASK.pop(tid, None)
+        if task:
+            logging.error('Task %s (%s) dropped, app server died during replay.' % (tid, task[0]))
+            sendmsg('Server error.', task[2][0], task[2][1])
+        else:
+            logging.error('App server died on start.')
+        return
+    logging.info('App server started, %s task(s) replayed.' % len(APP_TASK))
+
+def writeapp(obj):
+    with APP_LCK:
+        try:
+            appipc.writeframe(APP_P.stdin, obj)
+        except (BrokenPipeError, OSError):
+            # restartapp() resends everything in APP_TASK
+            restartapp()
 
 def runapptask(cmd, args, sendargs):
     '''`sendargs` should be (chatid, replyid)'''
-    global APP_P, APP_LCK, APP_TASK
     with APP_LCK:
-        # Prevent float problems
-        tid = str(time.time())
-        text = json.dumps({"cmd": cmd, "args": args, "id": tid})
-        APP_TASK[tid] = sendargs
-        try:
-            APP_P.stdin.write(text.strip().encode('utf-8') + b'\n')
-            APP_P.stdin.flush()
-        except BrokenPipeError:
-            checkappproc()
-            APP_P.stdin.write(text.strip().encode('utf-8') + b'\n')
-            APP_P.stdin.flush()
-        logging.debug('Wrote to APP_P: ' + text)
+        tid = next(APP_SEQ)
+        APP_TASK[tid] = [cmd, args, sendargs, 0, time.perf_counter()]
+        writeapp({"cmd": cmd, "args": args, "id": tid})
+    logging.debug('Wrote to APP_P: %s %s %r' % (tid, cmd, args))
 
 def getappresult():
-    global APP_P, APP_TASK
+    global APP_PONG, APP_HEALTH, APP_STARTED
     while 1:
-        try:
-            result = APP_P.stdout.readline().strip().decode('utf-8')
-        except BrokenPipeError:
-            checkappproc()
-            result = APP_P.stdout.readline().strip().decode('utf-8')
-        logging.debug('Got from APP_P: ' + result)
-        if result:
-            obj = json.loads(result)
-            if obj['exc']:
-                logging.error('Remote app server error.\n' + obj['exc'])
-            sargs = APP_TASK.get(obj['id'])
-            if sargs:
-                sendmsg(obj['ret'] or 'Empty.', sargs[0], sargs[1])
-                del APP_TASK[obj['id']]
-            else:
-                logging.error('Task ID %s not found.' % obj['id'])
-
-def checkircconn():
-    global ircconn
-    if not ircconn or not ircconn.sock:
-        ircconn = libirc.IRCConnection()
-        ircconn.connect((CFG['ircserver'], CFG['ircport']), use_ssl=CFG['ircssl'])
-        if CFG.get('ircpass'):
-            ircconn.setpass(CFG['ircpass'])
-        ircconn.setnick(CFG['ircnick'])
-        ircconn.setuser(CFG['ircnick'], CFG['ircnick'])
-        ircconn.join(CFG['ircchannel'])
-        logging.info('IRC (re)connected.')
-
-def getircupd():
-    global MSG_Q, IRCOFFSET
+        proc = APP_P
+        obj = appipc.readframe(proc.stdout)
+        if obj is None:
+            with APP_LCK:
+                if APP_STOP:
+                    return
+                # may already be restarted by writeapp or apphealthcheck
+                if APP_P is proc:
+                    restartapp()
+            continue
+        logging.debug('Got from APP_P: %r' % obj)
+        APP_PONG = time.time()
+        if APP_STARTED is not None:
+            METRICS.histogram('app.ready').observe(time.perf_counter() - APP_STARTED)
+            logging.info('App server ready in %.3fs.' % (time.perf_counter() - APP_STARTED))
+            APP_STARTED = None
+        if obj['id'] in APP_PINGS:
+            APP_PINGS.discard(obj['id'])
+            APP_HEALTH = obj['ret']
+            continue
+        if obj['exc']:
+            logging.error('Remote app server error.\n' + obj['exc'])
+        sargs = APP_TASK.pop(obj['id'], None)
+        if sargs:
+            METRICS.histogram('app.' + sargs[0]).observe(time.perf_counter() - sargs[4])
+            sendmsg(obj['ret'] or 'Empty.', sargs[2][0], sargs[2][1])
+        else:
+            logging.error('Task ID %s not found.' % obj['id'])
+
+def apphealthcheck():
     while 1:
-        checkircconn()
-        line = ircconn.parse(block=False)
-        if line and line["cmd"] == "PRIVMSG":
-            if line["dest"] != CFG['ircnick'] and not re.match(CFG['ircbanre'], line["nick"]):
-                msg = {
-                    'message_id': IRCOFFSET,
-                    'from': {'id': CFG['ircbotid'], 'first_name': CFG['ircbotname'], 'username': 'orzirc_bot'},
-                    'date': int(time.time()),
-                    'chat': {'id': -CFG['groupid'], 'title': CFG['ircchannel']},
-                    'text': line["msg"].strip(),
-                    '_ircuser': line["nick"]
-                }
-                MSG_Q.put({'update_id': IRCOFFSET, 'message': msg})
-                IRCOFFSET += 1
-        time.sleep(.5)
+        time.sleep(APP_HEARTBEAT)
+        if time.time() - APP_PONG > APP_HEARTBEAT * 3:
+            logging.error('App server not responding.')
+            with APP_LCK:
+                restartapp()
+            continue
+        with APP_LCK:
+            tid = next(APP_SEQ)
+            APP_PINGS.add(tid)
+            writeapp({"cmd": appipc.PING, "args": (), "id": tid})
+
+def ircconnect():
+    client = aioirc.IRCClient(CFG['ircserver'], CFG['ircport'], CFG['ircnick'], (CFG['ircchannel'],), CFG['ircssl'], CFG.get('ircpass'), getircupd, CFG.get('ircrate', 2), CFG.get('ircburst', 5))
+    client.start()
+    return client
+
+def getircupd(line):
+    '''Called from the IRC thread for every PRIVMSG.'''
+    global MSG_Q, IRCOFFSET
+    # a private message is addressed to the nick in use
+    if line["dest"] != line["me"] and not re.match(CFG['ircbanre'], line["nick"]):
+        msg = {
+            'message_id': IRCOFFSET,
+            'from': {'id': CFG['ircbotid'], 'first_name': CFG['ircbotname'], 'username': 'orzirc_bot'},
+            'date': int(time.time()),
+            'chat': {'id': -CFG['groupid'], 'title': CFG['ircchannel']},
+            'text': line["msg"].strip(),
+            '_ircuser': line["nick"]
+        }
+        MSG_Q.put({'update_id': IRCOFFSET, 'message': msg})
+        IRCOFFSET += 1
 
 def irc_send(text='', reply_to_message_id=None, forward_message_id=None):
     if ircconn:
-        checkircconn()
         if reply_to_message_id:
-            m = MSG_CACHE.get(reply_to_message_id, {})
-            logging.debug('Got reply message: ' + str(m))
-            if '_ircuser' in m:
-                text = "%s: %s" % (m['_ircuser'], text)
-            elif 'from' in m:
-                src = dc_getufname(m['from'])[:20]
-                if m['from']['id'] in (CFG['botid'], CFG['ircbotid']):
-                    rnmatch = re_ircforward.match(m.get('text', ''))
-                    if rnmatch:
-                        src = rnmatch.group(1) or src
-                text = "%s: %s" % (src, text)
+            attr = REPLY_IDX.get(reply_to_message_id)
+            logging.debug('Got reply attribution: %r' % (attr,))
+            if attr:
+                text = "%s: %s" % (attr[1] or attr[0], text)
         elif forward_message_id:
-            # not async, so no sqlite3.ProgrammingError in db_*
             m = db_getmsg(forward_message_id)
             if m:
                 text = "Fwd %s: %s" % (db_getufname(m[1])[:20], m[2])
@@ -213,12 +371,11 @@ def irc_send(text='', reply_to_message_id=None, forward_message_id=None):
         if text.count('\n') < 1:
             ircconn.say(CFG['ircchannel'], text)
 
-@async_func
 def irc_forward(msg):
+    '''Only queues the lines; aioirc sends them with flood control.'''
     if not ircconn:
         return
     try:
-        checkircconn()
         text = msg.get('text')
         if text and msg['from']['id'] != CFG['ircbotid'] and not text.startswith('@@@'):
             if 'forward_from' in msg:
@@ -231,14 +388,9 @@ def irc_forward(msg):
                 fwdname = fwdname or dc_getufname(msg['forward_from'])[:20]
                 text = "Fwd %s: %s" % (fwdname, text)
             elif 'reply_to_message' in msg:
-                replname = ''
-                replyu = msg['reply_to_message']['from']
-                if replyu['id'] in (CFG['botid'], CFG['ircbotid']):
-                    rnmatch = re_ircforward.match(msg['reply_to_message'].get('text', ''))
-                    if rnmatch:
-                        replname = rnmatch.group(1) or rnmatch.group(3)
-                replname = replname or dc_getufname(replyu)[:20]
-                text = "%s: %s" % (replname, text)
+                reply = msg['reply_to_message']
+                attr = REPLY_IDX.get(reply['message_id']) or REPLY_IDX.addmsg(reply)
+                text = "%s: %s" % (attr[1] or attr[0], text)
             # ignore blank lines
             text = list(filter(lambda s: s.strip(), text.splitlines()))
             if len(text) > 3:
@@ -317,17 +469,23 @@ def importdb(filename):
         logging.warning('DB not found.')
         return
     db_s = sqlite3.connect(filename)
-    conn_s = db_s.cursor()
-    for vals in conn_s.execute('SELECT id, src, text, media, date, fwd_src, fwd_date, reply_id, action FROM messages WHERE dest = ?', (CFG['groupid'],)):
-        vals = list(vals)
-        vals[0] = -250000 + vals[0]
-        vals[3], caption = mediaformatconv(vals[3], vals.pop())
-        vals[2] = vals[2] or caption
-        conn.execute('INSERT OR IGNORE INTO messages (id, src, text, media, date, fwd_src, fwd_date, reply_id) VALUES (?,?,?,?, ?,?,?,?)', vals)
-    for vals in conn_s.execute('SELECT id, username, first_name, last_name FROM users'):
-        conn.execute('INSERT OR IGNORE INTO users (id, username, first_name, last_name) VALUES (?,?,?,?)', vals)
-    db.commit()
-    logging.info('DB import done.')
+    def messages():
+        for mid, src, text, media, date, fwd_src, fwd_date, reply_id, action in db_s.execute('SELECT id, src, text, media, date, fwd_src, fwd_date, reply_id, action FROM messages WHERE dest = ?', (CFG['groupid'],)):
+            caption = None
+            if media or action:
+                media, caption = mediaformatconv(media, action)
+            yield (mid - 250000, src, text or caption, media, date, fwd_src, fwd_date, reply_id) + mediacols.fromjson(media)
+    start = time.perf_counter()
+    with DB.lock, sqlbulk.bulkmode(DB.writer, ('messages', 'users')) as cur:
+        count = sqlbulk.executemany(cur, 'INSERT OR IGNORE INTO messages (id, src, text, media, date, fwd_src, fwd_date, reply_id, media_type, irc_user, service) VALUES (?,?,?,?, ?,?,?,?, ?,?,?)', messages())
+        count += sqlbulk.executemany(cur, 'INSERT OR IGNORE INTO users (id, username, first_name, last_name) VALUES (?,?,?,?)', db_s.execute('SELECT id, username, first_name, last_name FROM users'))
+    with DB.write() as cur, DB.read() as r:
+        timeline.rebuild(cur, r.archive)
+        threads.rebuild(cur, r.archive)
+    DB.commit()
+    elapsed = time.perf_counter() - start
+    db_s.close()
+    logging.info('DB import done, %d rows in %.2fs, %.0f rows/s.' % (count, elapsed, count / elapsed))
 
 def importupdates(offset, number=5000):
     off = OFFSET - number
@@ -353,14 +511,16 @@ def importfixservice(filename):
         logging.warning('DB not found.')
         return
     db_s = sqlite3.connect(filename)
-    conn_s = db_s.cursor()
-    for mid, text, media, action in conn_s.execute('SELECT id, text, media, action FROM messages WHERE dest = ?', (CFG['groupid'],)):
-        mid -= 250000
-        media, caption = mediaformatconv(media, action)
-        text = text or caption
-        conn.execute('UPDATE messages SET text=?, media=? WHERE id=?', (text, media, mid))
-    db.commit()
-    logging.info('Fix DB media column done.')
+    def updates():
+        for mid, text, media, action in db_s.execute('SELECT id, text, media, action FROM messages WHERE dest = ?', (CFG['groupid'],)):
+            media, caption = mediaformatconv(media, action)
+            yield (text or caption, media) + mediacols.fromjson(media) + (mid - 250000,)
+    start = time.perf_counter()
+    with DB.lock, sqlbulk.bulkmode(DB.writer) as cur:
+        count = sqlbulk.executemany(cur, 'UPDATE messages SET text=?, media=?, media_type=?, irc_user=?, service=? WHERE id=?', updates())
+    elapsed = time.perf_counter() - start
+    db_s.close()
+    logging.info('Fix DB media column done, %d rows in %.2fs, %.0f rows/s.' % (count, elapsed, count / elapsed))
 
 ### API Related
 
@@ -375,6 +535,7 @@ def change_session():
     logging.warning('Session changed.')
 
 def bot_api(method, **params):
+    start = time.perf_counter()
     for att in range(3):
         try:
             req = HSession.get(URL + method, params=params)
@@ -386,8 +547,11 @@ def bot_api(method, **params):
                 time.sleep((att+1) * 2)
                 change_session()
             else:
+                METRICS.counter('bot_api.errors').inc()
                 raise ex
+    METRICS.histogram('bot_api.' + method).observe(time.perf_counter() - start)
     if not ret['ok']:
+        METRICS.counter('bot_api.failed').inc()
         raise BotAPIFailed(repr(ret))
     return ret['result']
 
@@ -411,7 +575,7 @@ def sync_sendmsg(text, chat_id, reply_to_message_id=None):
         reply_id = None
     m = bot_api('sendMessage', chat_id=chat_id, text=text, reply_to_message_id=reply_id)
     if chat_id == -CFG['groupid']:
-        MSG_CACHE[m['message_id']] = m
+        REPLY_IDX.addmsg(m)
         # IRC messages
         if reply_to_message_id is not None:
             LOG_Q.put(m)
@@ -494,6 +658,7 @@ def uniq(seq): # Dave Kirby
     seen = set()
     return [x for x in seq if x not in seen and not seen.add(x)]
 
+@METRICS.timed()
 def classify(msg):
     '''
     Classify message type:
@@ -551,7 +716,8 @@ def command(text, chatid, replyid, msg):
                 if chatid > 0 or chatid == -CFG['groupid'] or cmd in PUBLIC:
                     expr = ' '.join(t[1:]).strip()
                     logging.info('Command: /%s %s' % (cmd, expr[:20]))
-                    COMMANDS[cmd](expr, chatid, replyid, msg)
+                    with METRICS.timer('cmd.' + cmd):
+                        COMMANDS[cmd](expr, chatid, replyid, msg)
             elif chatid > 0:
                 sendmsg('Invalid command. Send /help for help.', chatid, replyid)
         # 233333
@@ -565,15 +731,33 @@ def command(text, chatid, replyid, msg):
         logging.exception('Excute command failed.')
 
 def processmsg():
-    d = MSG_Q.get()
+    global COMMIT_SIGNAL
+    if COMMIT_SIGNAL:
+        # asked by sig_commit, which can't take the locks of the main thread
+        REPLY_IDX.flush()
+        TIMELINE.flush()
+        DB.commit()
+        logging.info('DB committed upon signal %s' % COMMIT_SIGNAL)
+        COMMIT_SIGNAL = None
+    try:
+        d = MSG_Q.get(timeout=COMMIT_IDLE)
+    except queue.Empty:
+        # readers only see committed messages
+        REPLY_IDX.flush()
+        TIMELINE.flush()
+        DB.commit()
+        return
+    start = time.perf_counter()
     logging.debug('Msg arrived: %r' % d)
     uid = d['update_id']
     if 'message' in d:
         msg = d['message']
         if 'text' in msg:
             msg['text'] = msg['text'].replace('\xa0', ' ')
-        MSG_CACHE[msg['message_id']] = msg
+        if msg['chat']['id'] == -CFG['groupid']:
+            REPLY_IDX.addmsg(msg)
         cls = classify(msg)
+        METRICS.counter('msg.class.%s' % cls).inc()
         logging.debug('Classified as: %s', cls)
         if msg['chat']['id'] == -CFG['groupid'] and CFG.get('t2i'):
             irc_forward(msg)
@@ -605,6 +789,10 @@ def processmsg():
             logmsg(LOG_Q.get_nowait())
         except queue.Empty:
             pass
+        REPLY_IDX.flush()
+        TIMELINE.flush()
+        DB.commit(COMMIT_MAXAGE)
+    METRICS.histogram('processmsg').observe(time.perf_counter() - start)
 
 def autoclose(msg):
     openbrckt = ('([{（［｛⦅〚⦃“‘‹«「〈《【〔⦗『〖〘｢⟦⟨⟪⟮⟬⌈⌊⦇⦉❛❝❨❪❴❬❮❰❲'
@@ -629,14 +817,14 @@ def autoclose(msg):
 
 def db_adduser(d):
     user = (d['id'], d.get('username'), d.get('first_name'), d.get('last_name'))
-    conn.execute('REPLACE INTO users (id, username, first_name, last_name) VALUES (?, ?, ?, ?)', user)
+    DB.execute('REPLACE INTO users (id, username, first_name, last_name) VALUES (?, ?, ?, ?)', user)
     USER_CACHE[d['id']] = (d.get('username'), d.get('first_name'), d.get('last_name'))
     return user
 
 def db_getuser(uid):
     r = USER_CACHE.get(uid)
     if r is None:
-        r = conn.execute('SELECT username, first_name, last_name FROM users WHERE id = ?', (uid,)).fetchone() or (None, None, None)
+        r = DB.fetchone('SELECT username, first_name, last_name FROM users WHERE id = ?', (uid,)) or (None, None, None)
         USER_CACHE[uid] = r
     return r
 
@@ -657,15 +845,17 @@ def dc_getufname(user, maxlen=100):
 
 @functools.lru_cache(maxsize=10)
 def db_getmsg(mid):
-    return conn.execute('SELECT * FROM messages WHERE id = ?', (mid,)).fetchone()
+    with DB.read() as r:
+        return r.archive.getmsg(mid)
 
 @functools.lru_cache(maxsize=10)
 def db_getuidbyname(username):
-    uid = conn.execute('SELECT id FROM users WHERE username LIKE ?', (username,)).fetchone()
+    uid = DB.fetchone('SELECT id FROM users WHERE username LIKE ?', (username,))
     if uid:
         return uid[0]
 
 
+@METRICS.timed()
 def logmsg(d, iorignore=False):
     src = db_adduser(d['from'])[0]
     text = d.get('text') or d.get('caption', '')
@@ -673,8 +863,15 @@ def logmsg(d, iorignore=False):
     fwd_src = db_adduser(d['forward_from'])[0] if 'forward_from' in d else None
     reply_id = d['reply_to_message']['message_id'] if 'reply_to_message' in d else None
     into = 'INSERT OR IGNORE INTO' if iorignore else 'REPLACE INTO'
-    conn.execute(into + ' messages (id, src, text, media, date, fwd_src, fwd_date, reply_id) VALUES (?,?,?,?, ?,?,?,?)',
-                 (d['message_id'], src, text, json.dumps(media) if media else None, d['date'], fwd_src, d.get('forward_date'), reply_id))
+    with DB.write() as cur:
+        # REPLACE of a re-delivered update also has a rowcount of 1
+        new = cur.execute('SELECT 1 FROM messages WHERE id = ?', (d['message_id'],)).fetchone() is None
+        cur.execute(into + ' messages (id, src, text, media, date, fwd_src, fwd_date, reply_id, media_type, irc_user, service) VALUES (?,?,?,?, ?,?,?,?, ?,?,?)',
+                    (d['message_id'], src, text, json.dumps(media) if media else None, d['date'], fwd_src, d.get('forward_date'), reply_id) + mediacols.fromdict(media))
+        if reply_id or fwd_src:
+            threads.add(cur, d['message_id'], reply_id, fwd_src, d.get('forward_date'))
+    if new:
+        TIMELINE.add(d['date'])
     logging.info('Logged %s: %s', d['message_id'], d.get('text', '')[:15])
 
 ### Commands
@@ -703,13 +900,41 @@ def cmd_context(expr, chatid, replyid, msg):
     typing(chatid)
     forwardmulti_t(range(mid - limit, mid + limit + 1), chatid, replyid)
 
+def cmd_thread(expr, chatid, replyid, msg):
+    '''/thread [message_id] [number=20] Show the reply thread of the message, or of the message replied to. max=50'''
+    expr = expr.split()
+    try:
+        if expr:
+            mid = int(expr[0])
+        else:
+            mid = msg['reply_to_message']['message_id']
+        limit = max(min(int(expr[1]), 50), 1) if len(expr) > 1 else 20
+    except Exception:
+        sendmsg('Syntax error. Usage: ' + cmd_thread.__doc__, chatid, replyid)
+        return
+    typing(chatid)
+    with DB.read() as r:
+        rows = threads.thread(r.cur, mid, limit)
+        msgs = {i: r.archive.getmsg(i) for i, parent, depth in rows}
+    result = []
+    for i, parent, depth in rows:
+        m = msgs[i]
+        if m is None:
+            continue
+        text = m[2] or ''
+        if len(text) > 50:
+            text = text[:50] + '…'
+        result.append('%s[%d|%s] %s: %s' % ('  ' * min(depth, 8), i, time.strftime('%m-%d %H:%M:%S', time.gmtime(m[4] + CFG['timezone'] * 3600)), db_getufname(m[1]), text))
+    sendmsg('\n'.join(result) or 'Found nothing.', chatid, replyid)
+
 def cmd_quote(expr, chatid, replyid, msg):
     '''/quote Send a today's random message.'''
     typing(chatid)
     sec = daystart()
-    msg = conn.execute('SELECT id FROM messages WHERE date >= ? AND date < ? ORDER BY RANDOM() LIMIT 1', (sec, sec + 86400)).fetchone()
-    if msg is None:
-        msg = conn.execute('SELECT id FROM messages ORDER BY RANDOM() LIMIT 1').fetchone()
+    with DB.read() as r:
+        msg = r.cur.execute('SELECT id FROM messages WHERE date >= ? AND date < ? ORDER BY RANDOM() LIMIT 1', (sec, sec + 86400)).fetchone()
+        if msg is None:
+            msg = r.archive.randomrow('id')
     #forwardmulti((msg[0]-1, msg[0], msg[0]+1), chatid, replyid)
     forward(msg[0], chatid, replyid)
 
@@ -749,11 +974,13 @@ def cmd_search(expr, chatid, replyid, msg):
     if username:
         uid = db_getuidbyname(username)
     typing(chatid)
-    if uid is None:
-        keyword = ' '.join(expr)
-        sqr = conn.execute("SELECT id, src, text, date FROM messages WHERE text LIKE ? ORDER BY date DESC LIMIT ? OFFSET ?", ('%' + keyword + '%', limit, offset)).fetchall()
-    else:
-        sqr = conn.execute("SELECT id, src, text, date FROM messages WHERE src = ? AND text LIKE ? ORDER BY date DESC LIMIT ? OFFSET ?", (uid, '%' + keyword + '%', limit, offset)).fetchall()
+    with DB.read() as r:
+        if uid is None:
+            keyword = ' '.join(expr)
+            sqr = r.archive.select("SELECT id, src, text, date FROM {messages} WHERE text LIKE ? ORDER BY date DESC", ('%' + keyword + '%',), limit=limit + offset)
+        else:
+            sqr = r.archive.select("SELECT id, src, text, date FROM {messages} WHERE src = ? AND text LIKE ? ORDER BY date DESC", (uid, '%' + keyword + '%'), limit=limit + offset)
+        sqr = tuple(sqr)[offset:]
     result = []
     for mid, fr, text, date in sqr:
         text = ellipsisresult(text, keyword)
@@ -805,7 +1032,9 @@ def cmd_uinfo(expr, chatid, replyid, msg):
     uinfoln.append(db_getufname(uid))
     uinfoln.append('ID: %s' % uid)
     result = [', '.join(uinfoln)]
-    r = conn.execute('SELECT src FROM messages WHERE date > ?', (time.time() - minutes * 60,)).fetchall()
+    since = time.time() - minutes * 60
+    with DB.read() as rd:
+        r = tuple(rd.archive.select('SELECT src FROM {messages} WHERE date > ?', (since,), start=since))
     timestr = timestring(minutes)
     if r:
         ctr = collections.Counter(i[0] for i in r)
@@ -818,13 +1047,44 @@ def cmd_uinfo(expr, chatid, replyid, msg):
         result.append('在最近%s内没发消息。' % timestr)
     sendmsg('\n'.join(result), chatid, replyid)
 
+SPARKS = '▁▂▃▄▅▆▇█'
+# bucket sizes of /stat chart in minutes, at most 24 buckets
+CHART_STEPS = (1, 5, 10, 15, 30, 60, 120, 180, 360, 720, 1440)
+
+def sparkline(values):
+    top = max(values)
+    return ''.join(SPARKS[v * (len(SPARKS) - 1) // top] for v in values)
+
+def statchart(minutes, chatid, replyid):
+    step = next((s for s in CHART_STEPS if minutes <= s * 24), -(-minutes // (1440 * 24)) * 1440)
+    tz = CFG['timezone'] * 3600
+    # the last bucket is the current one, aligned to local time
+    end = ((int(time.time()) + tz) // (step * 60) + 1) * step * 60 - tz
+    start = end - -(-minutes // step) * step * 60
+    values = TIMELINE.series(start, end, step * 60)
+    timestr = timestring(minutes)
+    if not any(values):
+        sendmsg('在最近%s内无消息。' % timestr, chatid, replyid)
+        return
+    fmt = lambda t: time.strftime('%Y-%m-%d' if step >= 1440 else '%m-%d %H:%M', time.gmtime(t + tz))
+    peak = max(range(len(values)), key=values.__getitem__)
+    sendmsg('最近%s每%s的消息数：\n%s\n%s 至 %s 共 %d 条，最多在 %s 起的%s内，%d 条。' % (
+        timestr, timestring(step), sparkline(values), fmt(start), fmt(end), sum(values),
+        fmt(start + peak * step * 60), timestring(step), values[peak]), chatid, replyid)
+
 def cmd_stat(expr, chatid, replyid, msg):
-    '''/stat [minutes=1440] Show statistics.'''
+    '''/stat [chart] [minutes=1440] Show statistics, or a chart of the activity.'''
+    expr = expr.split()
     try:
-        minutes = min(max(int(expr), 1), 3359733)
+        minutes = min(max(int(expr[-1]), 1), 3359733)
     except Exception:
         minutes = 1440
-    r = conn.execute('SELECT src FROM messages WHERE date > ?', (time.time() - minutes * 60,)).fetchall()
+    if expr[:1] == ['chart']:
+        statchart(minutes, chatid, replyid)
+        return
+    since = time.time() - minutes * 60
+    with DB.read() as rd:
+        r = tuple(rd.archive.select('SELECT src FROM {messages} WHERE date > ?', (since,), start=since))
     timestr = timestring(minutes)
     if not r:
         sendmsg('在最近%s内无消息。' % timestr, chatid, replyid)
@@ -842,9 +1102,11 @@ def cmd_digest(expr, chatid, replyid, msg):
 
 def cmd_calc(expr, chatid, replyid, msg):
     '''/calc <expr> Calculate <expr>.'''
-    # Too many bugs
     if expr:
-        runapptask('calc', (expr,), (chatid, replyid))
+        if len(expr) > 1000:
+            sendmsg('Expression too long.', chatid, replyid)
+        else:
+            runapptask('calc', (expr,), (chatid, replyid))
     else:
         sendmsg('Syntax error. Usage: ' + cmd_calc.__doc__, chatid, replyid)
 
@@ -958,7 +1220,7 @@ def cmd_reply(expr, chatid, replyid, msg):
     text = ''
     if 'reply_to_message' in msg:
         text = msg['reply_to_message'].get('text', '')
-    text = (expr.strip() or text or ' '.join(t[0] for t in conn.execute("SELECT text FROM messages ORDER BY date DESC LIMIT 2").fetchall())).replace('\n', ' ')
+    text = (expr.strip() or text or ' '.join(t[0] for t in DB.fetchall("SELECT text FROM messages ORDER BY date DESC LIMIT 2"))).replace('\n', ' ')
     runapptask('reply', (text,), (chatid, replyid))
 
 def cmd_echo(expr, chatid, replyid, msg):
@@ -1027,13 +1289,11 @@ def cmd_autoclose(expr, chatid, replyid, msg):
             sendmsg('Auto closing brackets enabled.', chatid, replyid)
 
 def cmd__cmd(expr, chatid, replyid, msg):
-    global SAY_P, APP_P
     if chatid < 0:
         return
     if expr == 'killserver':
-        APP_P.terminate()
-        APP_P = subprocess.Popen(APP_CMD, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
-        checkappproc()
+        with APP_LCK:
+            restartapp()
         sendmsg('Server restarted.', chatid, replyid)
         logging.info('Server restarted upon user request.')
     elif expr == 'commit':
@@ -1042,9 +1302,19 @@ def cmd__cmd(expr, chatid, replyid, msg):
                 logmsg(LOG_Q.get_nowait())
             except queue.Empty:
                 break
-        db.commit()
+        REPLY_IDX.flush()
+        TIMELINE.flush()
+        DB.commit()
         sendmsg('DB committed.', chatid, replyid)
         logging.info('DB committed upon user request.')
+    elif expr == 'stats':
+        text = METRICS.format()
+        if APP_HEALTH:
+            # model load times reported by appserve.py and its workers
+            for w in APP_HEALTH.get('workers') or (APP_HEALTH,):
+                for name, sec in sorted((w.get('loaded') or {}).items()):
+                    text += '\napp.load.%s %.2f' % (name, sec)
+        sendmsg(text, chatid, replyid)
     #elif expr == 'raiseex':  # For debug
         #async_func(_raise_ex)(Exception('/_cmd raiseex'))
     #else:
@@ -1102,20 +1372,30 @@ def cmd_help(expr, chatid, replyid, msg):
         sendmsg('\n'.join(uniq(cmd.__doc__ for cmdname, cmd in COMMANDS.items() if cmd.__doc__ and cmdname in PUBLIC)), chatid, replyid)
 
 def sig_commit(signum, frame):
-    db.commit()
-    logging.info('DB committed upon signal %s' % signum)
+    # runs on the main thread, maybe inside REPLY_IDX.add(): processmsg()
+    # commits within COMMIT_IDLE
+    global COMMIT_SIGNAL
+    COMMIT_SIGNAL = signum
+
+def sig_profile(signum, frame):
+    fn = PROFILER.toggle()
+    if fn:
+        logging.info('Profile of %d samples written to %s, top: %s' % (PROFILER.samples, fn, PROFILER.top(5)))
+    else:
+        logging.info('Profiler started upon signal %s' % signum)
 
 # should document usage in docstrings
 COMMANDS = collections.OrderedDict((
 ('m', cmd_getmsg),
 ('context', cmd_context),
+('thread', cmd_thread),
 ('s', cmd_search),
 ('search', cmd_search),
 ('user', cmd_uinfo),
 ('uinfo', cmd_uinfo),
 ('digest', cmd_digest),
 ('stat', cmd_stat),
-#('calc', cmd_calc),
+('calc', cmd_calc),
 #('calc', cmd_py),
 ('py', cmd_py),
 ('bf', cmd_bf),
@@ -1161,66 +1441,116 @@ PUBLIC = set((
 
 srandom = random.SystemRandom()
 
-OFFSET = conn.execute('SELECT val FROM config WHERE id = 0').fetchone()
-OFFSET = OFFSET[0] if OFFSET else 0
-IRCOFFSET = conn.execute('SELECT val FROM config WHERE id = 1').fetchone()
-IRCOFFSET = IRCOFFSET[0] if IRCOFFSET else -1000000
+DB = None
+# commit after this many seconds without messages, or once the oldest
+# write not committed is COMMIT_MAXAGE old
+COMMIT_IDLE = 1
+COMMIT_MAXAGE = 10
+# signal number of a commit asked by SIGUSR1
+COMMIT_SIGNAL = None
+CFG = {}
+URL = None
+OFFSET = 0
+IRCOFFSET = -1000000
 USER_CACHE = LRUCache(20)
-MSG_CACHE = LRUCache(10)
-CFG = json.load(open('config.json'))
-URL = 'https://api.telegram.org/bot%s/' % CFG['token']
-
-# Initialize messages in database
-
-#importdb('telegram-history.db')
-#importupdates(OFFSET, 2000)
-#importfixservice('telegram-history.db')
-#sys.exit(0)
-
-signal.signal(signal.SIGUSR1, sig_commit)
+REPLY_IDX = None
+TIMELINE = None
 
 MSG_Q = queue.Queue()
 LOG_Q = queue.Queue()
+# task id -> [cmd, args, (chatid, replyid), restarts, perf_counter at submit]
 APP_TASK = {}
-APP_LCK = threading.Lock()
+APP_SEQ = itertools.count(1)
+APP_PINGS = set()
+APP_HEALTH = None
+APP_HEARTBEAT = 10
+APP_RETRY = 2
+APP_LCK = threading.RLock()
 APP_CMD = ('python3', 'appserve.py')
-APP_P = subprocess.Popen(APP_CMD, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+APP_P = None
+# set on shutdown, when appserve.py is not restarted
+APP_STOP = False
+# perf_counter at the last restartapp() until the first answer
+APP_STARTED = None
+METRICS.gauge('msg_q', MSG_Q.qsize)
+METRICS.gauge('log_q', LOG_Q.qsize)
+METRICS.gauge('app_task', APP_TASK.__len__)
 
-pollthr = threading.Thread(target=getupdates)
-pollthr.daemon = True
-pollthr.start()
+ircconn = None
 
-appthr = threading.Thread(target=getappresult)
-appthr.daemon = True
-appthr.start()
+def main():
+    global ircconn, APP_STOP
+    start = time.perf_counter()
+    with startup('config'):
+        loadconfig()
+    # "host:port" or a unix socket path
+    if CFG.get('metrics'):
+        metrics.serve(METRICS, CFG['metrics'])
+    with startup('db'):
+        initdb('chatlog.db', CFG.get('archivedir', 'archive'), CFG.get('dbreaders', 4), CFG.get('timelinedays', 7))
+    # for alerts on the metrics endpoint
+    METRICS.gauge('timeline.last_hour', TIMELINE.recent)
 
-ircconn = None
-if 'ircserver' in CFG:
-    checkircconn()
-    ircthr = threading.Thread(target=getircupd)
-    ircthr.daemon = True
-    ircthr.start()
+    # Initialize messages in database
 
-# fx233es = fparser.Parser(numtype='decimal')
+    #importdb('telegram-history.db')
+    #importupdates(OFFSET, 2000)
+    #importfixservice('telegram-history.db')
+    #sys.exit(0)
 
-logging.info('Satellite launched.')
+    signal.signal(signal.SIGUSR1, sig_commit)
+    signal.signal(signal.SIGUSR2, sig_profile)
 
-try:
-    while 1:
-        try:
-            processmsg()
-        except Exception as ex:
-            logging.exception('Failed to process a message.')
-            continue
-finally:
-    while 1:
-        try:
-            logmsg(LOG_Q.get_nowait())
-        except queue.Empty:
-            break
-    conn.execute('REPLACE INTO config (id, val) VALUES (0, ?)', (OFFSET,))
-    conn.execute('REPLACE INTO config (id, val) VALUES (1, ?)', (IRCOFFSET,))
-    json.dump(CFG, open('config.json', 'w'), sort_keys=True, indent=4)
-    db.commit()
-    APP_P.terminate()
-    logging.info('Shut down cleanly.')
+    # appserve.py loads its models in the background; app.ready is
+    # the time until it answers
+    with startup('appserve'), APP_LCK:
+        restartapp()
+
+    pollthr = threading.Thread(target=getupdates)
+    pollthr.daemon = True
+    pollthr.start()
+
+    appthr = threading.Thread(target=getappresult)
+    appthr.daemon = True
+    appthr.start()
+
+    apphthr = threading.Thread(target=apphealthcheck)
+    apphthr.daemon = True
+    apphthr.start()
+
+    if 'ircserver' in CFG:
+        with startup('irc'):
+            ircconn = ircconnect()
+
+    # fx233es = fparser.Parser(numtype='decimal')
+
+    METRICS.gauge('startup.total').set(time.perf_counter() - start)
+    logging.info('Satellite launched in %.3fs.' % (time.perf_counter() - start))
+
+    try:
+        while 1:
+            try:
+                processmsg()
+            except Exception as ex:
+                METRICS.counter('processmsg.errors').inc()
+                logging.exception('Failed to process a message.')
+                continue
+    finally:
+        while 1:
+            try:
+                logmsg(LOG_Q.get_nowait())
+            except queue.Empty:
+                break
+        DB.execute('REPLACE INTO config (id, val) VALUES (0, ?)', (OFFSET,))
+        DB.execute('REPLACE INTO config (id, val) VALUES (1, ?)', (IRCOFFSET,))
+        json.dump(CFG, open('config.json', 'w'), sort_keys=True, indent=4)
+        REPLY_IDX.flush()
+        TIMELINE.flush()
+        DB.close()
+        with APP_LCK:
+            APP_STOP = True
+            APP_P.terminate()
+        logging.info('Shut down cleanly.')
+
+if __name__ == '__main__':
+    main()
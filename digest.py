@@ -20,6 +20,11 @@ import truecaser
 #import jieba.analyse
 from vendor import mosesproxy as jieba
 from vendor import zhconv
+from vendor import archive
+from vendor import colstore
+from vendor import threads
+from vendor import timeline
+from vendor import mediacols
 
 NAME = '##Orz'
 TITLE = '##Orz 分部喵'
@@ -31,6 +36,13 @@ CHUNKINTERV = 120
 CFG = json.load(open('config.json'))
 db = sqlite3.connect('chatlog.db')
 conn = db.cursor()
+ARCHIVE = archive.Router(conn, CFG.get('archivedir', 'archive'))
+# directory of the columnar export for the stat page, see vendor/colstore.py
+COLSTORE = CFG.get('colstore')
+# hourly counts kept by chatdig.py, see vendor/timeline.py
+HAS_TIMELINE = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'timeline'").fetchone() is not None
+# reply and forward links kept by chatdig.py, see vendor/threads.py
+HAS_THREADS = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'threads'").fetchone() is not None
 
 USER_CACHE = {}
 
@@ -55,6 +67,7 @@ MEDIA_TYPES = {
 }
 
 SERVICE = frozenset(('new_chat_participant', 'left_chat_participant', 'new_chat_title', 'new_chat_photo', 'delete_chat_photo', 'group_chat_created'))
+NEW_CHAT_TITLE = mediacols.MEDIA_CODE['new_chat_title']
 
 def daystart(sec=None):
     if not sec:
@@ -79,10 +92,10 @@ def db_getuser(uid):
 def db_isbot(uid):
     return (db_getuser(uid)[0] or '').lower().endswith('bot')
 
-def db_getufname(uid, mmedia=None):
+def db_getufname(uid, ircuser=None):
     if uid == CFG['ircbotid']:
-        if mmedia and '_ircuser' in mmedia:
-            return mmedia['_ircuser']
+        if ircuser:
+            return ircuser
         else:
             return '<IRC 用户>'
     else:
@@ -91,10 +104,10 @@ def db_getufname(uid, mmedia=None):
             name += ' ' + last
         return name or '<未知>'
 
-def db_getfirstname(uid, mmedia=None):
+def db_getfirstname(uid, ircuser=None):
     if uid == CFG['ircbotid']:
-        if mmedia and '_ircuser' in mmedia:
-            return mmedia['_ircuser']
+        if ircuser:
+            return ircuser
         else:
             return '<IRC 用户>'
     else:
@@ -185,8 +198,9 @@ class DigestComposer:
         last, lastid = start[0], 0
         msgs = collections.OrderedDict()
         intervals = ([], [])
-        for mid, src, text, date, fwd_src, fwd_date, reply_id, media in conn.execute('SELECT id, src, text, date, fwd_src, fwd_date, reply_id, media FROM messages WHERE date >= ? AND date < ? ORDER BY date ASC, id ASC', (start[0], end[1])):
-            msgs[mid] = (src, text or '', date, fwd_src, fwd_date, reply_id, media)
+        for mid, src, text, date, fwd_src, fwd_date, reply_id, media_type, irc_user, service in ARCHIVE.select('SELECT id, src, text, date, fwd_src, fwd_date, reply_id, media_type, irc_user, service FROM {messages} WHERE date >= ? AND date < ? ORDER BY date ASC, id ASC', (start[0], end[1]), start=start[0], end=end[1], asc=True):
+            # media is (media_type, irc_user, service), see vendor/mediacols.py
+            msgs[mid] = (src, text or '', date, fwd_src, fwd_date, reply_id, (media_type, irc_user, service))
             if start[0] <= date < start[1]:
                 intervals[0].append((date - last, mid))
             elif last < start[1] <= date:
@@ -218,16 +232,32 @@ class DigestComposer:
                 yield t
 
     def msgindex(self):
-        self.fwd_lookup = {}
+        fwd_lookup = {}
         self.words = collections.Counter()
         self.msgtok = {}
         for mid, value in self.msgs.items():
             src, text, date, fwd_src, fwd_date, reply_id, media = value
-            self.fwd_lookup[(src, date)] = mid
+            fwd_lookup[(src, date)] = mid
             tok = self.msgtok[mid] = tuple(self.msgpreprocess(zhconv.convert(self.tc.truecase(re_url.sub('', stripreaction(text))), 'zh-hans')))
             for w in frozenset(t.lower() for t in tok):
                 self.words[w] += 1
         self.words = dict(self.words)
+        # mid -> (replied or forwarded message, is forward)
+        if HAS_THREADS:
+            self.parents = threads.parents(conn, tuple(self.msgs))
+        else:
+            self.parents = {}
+            for mid, value in self.msgs.items():
+                orig = fwd_lookup.get((value[3], value[4]))
+                if orig is not None:
+                    self.parents[mid] = (orig, 1)
+                elif value[5] is not None:
+                    self.parents[mid] = (value[5], 0)
+
+    def original(self, mid):
+        '''The original of a forwarded message of the day, or mid.'''
+        parent = self.parents.get(mid)
+        return parent[0] if parent and parent[1] and parent[0] in self.msgs else mid
 
     def chunker(self):
         results = []
@@ -235,7 +265,8 @@ class DigestComposer:
         last = 0
         for mid, value in self.msgs.items():
             src, text, date, fwd_src, fwd_date, reply_id, media = value
-            if date - last > CHUNKINTERV and chunk:
+            # a reply to the current chunk continues it after a pause
+            if date - last > CHUNKINTERV and chunk and self.parents.get(mid, (None,))[0] not in chunk:
                 results.append(chunk)
                 chunk = []
             last = date
@@ -282,8 +313,7 @@ class DigestComposer:
             else:
                 return 3
         elif src == CFG['ircbotid']:
-            mmedia = json.loads(media or '{}')
-            if self.ircbots.match(mmedia.get('_ircuser', '')):
+            if self.ircbots.match(media[1] or ''):
                 return 3
             else:
                 return 0
@@ -302,7 +332,7 @@ class DigestComposer:
             src, text, date, fwd_src, fwd_date, reply_id, media = self.msgs[mid]
             if self.classify(mid) > 1:
                 continue
-            backlink = self.fwd_lookup.get((fwd_src, fwd_date)) or reply_id
+            backlink = self.parents.get(mid, (None,))[0]
             if (backlink in self.msgs and (mid, backlink) not in edges):
                 edges[(mid, backlink)] = similarity(mid, backlink)
             for mid2, value2 in self.msgs.items():
@@ -321,13 +351,13 @@ class DigestComposer:
             kwds = self.tfidf_kwd(itertools.chain.from_iterable(self.msgtok[mid] for mid in chunk if self.classify(mid) < 2))
             hotmsg = []
             wordinmsg = lambda x: re_word.search(self.msgs[x][1])
-            ranked = uniq(uniq(filter(wordinmsg, map(lambda x: self.fwd_lookup.get(operator.itemgetter(3, 4)(self.msgs[x[0]]), x[0]), self.hotrank(chunk)))), key=lambda x: self.tc.truecase(self.msgs[x][1])) or list(filter(wordinmsg, chunk)) or chunk
+            ranked = uniq(uniq(filter(wordinmsg, map(lambda x: self.original(x[0]), self.hotrank(chunk)))), key=lambda x: self.tc.truecase(self.msgs[x][1])) or list(filter(wordinmsg, chunk)) or chunk
             for mid in (ranked[:10] or chunk[:10]):
                 msg = self.msgs[mid]
                 text = msg[1]
                 if len(text) > 500:
                     text = text[:500] + '…'
-                hotmsg.append((mid, stripreaction(text), msg[0], db_getfirstname(msg[0], json.loads(msg[6] or '{}')), strftime('%H:%M:%S', msg[2])))
+                hotmsg.append((mid, stripreaction(text), msg[0], db_getfirstname(msg[0], msg[6][1]), strftime('%H:%M:%S', msg[2])))
             yield (kwds, hotmsg)
 
     def tags(self):
@@ -341,9 +371,9 @@ class DigestComposer:
     def tc_preprocess(self):
         prefix = [self.title]
         for mid, value in self.msgs.items():
-            media = json.loads(value[6] or '{}')
-            if 'new_chat_title' in media:
-                text = media['new_chat_title']
+            media_type, irc_user, service = value[6]
+            if media_type == NEW_CHAT_TITLE:
+                text = service
                 for k in range(len(prefix), -1, -1):
                     pf = ''.join(prefix[:k])
                     if text.startswith(pf):
@@ -392,10 +422,25 @@ class DigestComposer:
             'flooder': tuple(((k, db_getufname(k)), v, '%.2f%%' % (v/count*100)) for k, v in mcomm),
             'tags': self.tags()[:6],
             'others': (others, '%.2f%%' % (others/count*100)),
-            'avg': '%.2f' % (count / len(ctr))
+            'avg': '%.2f' % (count / len(ctr)),
+            'activity': self.activity()
         }
         return stat
 
+    def activity(self):
+        '''
+        (hour, count, bar width, average of the 7 days before) of each
+        hour of the day.
+        '''
+        if not HAS_TIMELINE:
+            return ()
+        start = daystart(self.date)
+        day = timeline.hourly(conn, start, start + 86400)
+        week = timeline.hourly(conn, start - 7 * 86400, start)
+        avg = [sum(week[h::24]) / 7 for h in range(24)]
+        top = max(day + avg) or 1
+        return tuple((h, n, '%.2f%%' % (n * 100 / top), '%.1f' % a) for h, (n, a) in enumerate(zip(day, avg)))
+
     def render(self):
         kvars = {
             'name': NAME,
@@ -416,12 +461,18 @@ class StatComposer:
         self.tc = truecaser.Truecaser(truecaser.loaddict(open('vendor/truecase.txt', 'rb')))
 
     def fetchmsgstat(self):
+        if COLSTORE:
+            return self.fetchcolstat()
         self.msglen = self.start = self.end = 0
         hourctr = [0] * 24
         mediactr = collections.Counter()
         usrctr = collections.Counter()
         tags = collections.Counter()
-        for mid, src, text, date, media in conn.execute('SELECT id, src, text, date, media FROM messages ORDER BY date ASC, id ASC'):
+        # media_type -> key of MEDIA_TYPES
+        category = {code: mt if mt in MEDIA_TYPES else 'service' if mt in SERVICE else 'text'
+                    for code, mt in enumerate(('text',) + mediacols.MEDIA_TYPES)}
+        category[None] = 'text'
+        for mid, src, text, date, media_type in ARCHIVE.select('SELECT id, src, text, date, media_type FROM {messages} ORDER BY date ASC, id ASC', asc=True):
             text = text or ''
             if not self.start:
                 self.start = date
@@ -429,19 +480,36 @@ class StatComposer:
             self.end = max(self.end, date)
             for tag in re_tag.findall(text):
                 tags[self.tc.truecase(tag)] += 1
-            media = json.loads(media or '{}')
-            mt = media.keys() & MEDIA_TYPES.keys()
-            if mt:
-                t = tuple(mt)[0]
-            elif media.keys() & SERVICE:
-                t = 'service'
-            else:
-                t = 'text'
             hourctr[int(((date + TIMEZONE) // 3600) % 24)] += 1
-            mediactr[t] += 1
+            mediactr[category[media_type]] += 1
             usrctr[src] += 1
             self.msglen += 1
         self.end = date
+        return self.summarize(hourctr, mediactr, tags, usrctr)
+
+    def fetchcolstat(self):
+        '''fetchmsgstat() reading only the needed columns of the export.'''
+        colstore.export('chatlog.db', COLSTORE, CFG.get('archivedir', 'archive'))
+        cols = colstore.Reader(os.path.join(COLSTORE, 'messages.col')).read(('src', 'text', 'date', 'mtype'))
+        # NumPy arrays, or lists without NumPy
+        tolist = lambda a: a if isinstance(a, list) else a.tolist()
+        dates = tolist(cols['date'])
+        self.msglen = len(dates)
+        self.start, self.end = dates[0], dates[-1]
+        hourctr = [0] * 24
+        for date in dates:
+            hourctr[int(((date + TIMEZONE) // 3600) % 24)] += 1
+        mediactr = collections.Counter()
+        for mt, v in collections.Counter(tolist(cols['mtype'])).items():
+            mediactr[mt if mt in MEDIA_TYPES else 'service' if mt in SERVICE else 'text'] += v
+        usrctr = collections.Counter(tolist(cols['src']))
+        tags = collections.Counter()
+        for text in cols['text']:
+            for tag in re_tag.findall(text):
+                tags[self.tc.truecase(tag)] += 1
+        return self.summarize(hourctr, mediactr, tags, usrctr)
+
+    def summarize(self, hourctr, mediactr, tags, usrctr):
         typesum = sum(mediactr.values())
         types = [(MEDIA_TYPES[k], '%.2f%%' % (v * 100 / typesum)) for k, v in mediactr.most_common()]
         tags = sorted(filter(lambda x: x[1] > 2, tags.items()), key=lambda x: (-x[1], x[0]))
@@ -462,10 +530,19 @@ class StatComposer:
             'hours': hourdist,
             'types': types,
             'tags': tags,
-            'avg': '%.2f' % (count / len(usrctr))
+            'avg': '%.2f' % (count / len(usrctr)),
+            'months': self.months()
         }
         return stat
 
+    def months(self):
+        '''(month, count, bar width) of the whole log.'''
+        if not HAS_TIMELINE:
+            return ()
+        months = timeline.totals(conn, '%Y-%m', TIMEZONE)
+        top = max((v for k, v in months), default=0) or 1
+        return tuple((k, v, '%.2f%%' % (v * 100 / top)) for k, v in months)
+
     def render(self):
         kvars = {
             'name': NAME,
@@ -7,16 +7,27 @@ import sys
 import json
 import time
 import queue
+import shlex
+import bisect
 import sqlite3
 import operator
 import threading
 import itertools
 import functools
 import subprocess
-import collections
+
+from vendor import sqlbulk
 
 DB_NAME = 'telegram-history.db' # SQLite 3 database file name.
 CHAT_NAME = '@@Orz_分部喵'
+TG_DIR = '/home/gumble/dev/tg'
+#TG_DIR = '/home/gumble/github/tg'
+TG_CMD = (os.path.join(TG_DIR, 'bin/telegram-cli'), '--json', '-RC')
+# history requests written to telegram-cli before their replies arrive
+IN_FLIGHT = 4
+# seconds without output before in-flight requests are considered lost
+TIMEOUT = 30
+COMMIT_EVERY = 2000
 
 db = sqlite3.connect(DB_NAME)
 conn = db.cursor()
@@ -51,61 +62,88 @@ members_num INTEGER,
 flags INTEGER
 )''')
 
-logged = set()
+class HoleSet:
+    '''
+    Message ids in [1, maxid] not logged yet, as sorted disjoint
+    [start, end] intervals. add() is O(log n) for ids below maxid and
+    O(1) for new ones.
+    '''
 
-class LRUCache:
+    def __init__(self):
+        self.starts = []
+        self.ends = []
+        self.maxid = 0
+        self.size = 0
 
-    def __init__(self, maxlen):
-        self.capacity = maxlen
-        self.cache = collections.OrderedDict()
+    def add(self, mid):
+        if mid > self.maxid:
+            if mid > self.maxid + 1:
+                self.starts.append(self.maxid + 1)
+                self.ends.append(mid - 1)
+                self.size += mid - 1 - self.maxid
+            self.maxid = mid
+            return
+        k = bisect.bisect_right(self.starts, mid) - 1
+        if k < 0 or self.ends[k] < mid:
+            return
+        start, end = self.starts[k], self.ends[k]
+        self.size -= 1
+        if start == end:
+            del self.starts[k], self.ends[k]
+        elif mid == start:
+            self.starts[k] = mid + 1
+        elif mid == end:
+            self.ends[k] = mid - 1
+        else:
+            self.ends[k] = mid - 1
+            self.starts.insert(k + 1, mid + 1)
+            self.ends.insert(k + 1, end)
 
-    def __getitem__(self, key):
-        value = self.cache.pop(key)
-        self.cache[key] = value
-        return value
+    def __len__(self):
+        return self.size
 
-    def get(self, key):
-        try:
-            value = self.cache.pop(key)
-            self.cache[key] = value
-            return value
-        except KeyError:
-            return None
+    def __iter__(self):
+        return zip(self.starts, self.ends)
 
-    def __setitem__(self, key, value):
-        try:
-            self.cache.pop(key)
-        except KeyError:
-            if len(self.cache) >= self.capacity:
-                self.cache.popitem(last=False)
-        self.cache[key] = value
+holes = HoleSet()
+logcount = 0
+
+MSG_SQL = 'REPLACE INTO messages (id, src, dest, text, media, date, fwd_src, fwd_date, reply_id, out, unread, service, action, flags) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'
+USER_SQL = 'REPLACE INTO users (id, phone, username, first_name, last_name, flags) VALUES (?,?,?,?,?,?)'
+CHAT_SQL = 'REPLACE INTO chats (id, title, members_num, flags) VALUES (?,?,?,?)'
+
+msgrow = lambda msg: (msg['id'], msg['from']['id'], msg['to']['id'], msg.get('text'), json.dumps(msg['media']) if 'media' in msg else None, msg['date'], msg['fwd_from']['id'] if 'fwd_from' in msg else None, msg.get('fwd_date'), msg.get('reply_id'), msg['out'], msg['unread'], msg['service'], json.dumps(msg['action']) if 'action' in msg else None, msg['flags'])
+userrow = lambda peer: (peer['id'], peer.get('phone'), peer.get('username'), peer.get('first_name'), peer.get('last_name'), peer.get('flags'))
+chatrow = lambda peer: (peer['id'], peer['title'], peer['members_num'], peer['flags'])
+msgpeers = lambda msg: (msg['from'], msg['to'], msg['fwd_from']) if 'fwd_from' in msg else (msg['from'], msg['to'])
 
-peer_cache = LRUCache(5)
+# (id, type) of peers written in this run
+peer_seen = set()
 
 def update_peer(peer):
-    global peer_cache
-    res = peer_cache.get((peer['id'], peer['type']))
-    if res:
+    key = (peer['id'], peer['type'])
+    if key in peer_seen:
         return peer
     if peer['type'] == 'user':
-        conn.execute('REPLACE INTO users (id, phone, username, first_name, last_name, flags) VALUES (?,?,?,?,?,?)', (peer['id'], peer.get('phone'), peer.get('username'), peer.get('first_name'), peer.get('last_name'), peer.get('flags')))
+        conn.execute(USER_SQL, userrow(peer))
     elif peer['type'] == 'chat':
-        conn.execute('REPLACE INTO chats (id, title, members_num, flags) VALUES (?,?,?,?)', (peer['id'], peer['title'], peer['members_num'], peer['flags']))
-    peer_cache[(peer['id'], peer['type'])] = 1
+        conn.execute(CHAT_SQL, chatrow(peer))
+    peer_seen.add(key)
     # not support PEER_ENCR_CHAT
     return peer
 
 def log_msg(msg):
-    update_peer(msg['from'])
-    update_peer(msg['to'])
-    if 'fwd_from' in msg:
-        update_peer(msg['fwd_from'])
-    conn.execute('REPLACE INTO messages (id, src, dest, text, media, date, fwd_src, fwd_date, reply_id, out, unread, service, action, flags) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', (msg['id'], msg['from']['id'], msg['to']['id'], msg.get('text'), json.dumps(msg['media']) if 'media' in msg else None, msg['date'], msg['fwd_from']['id'] if 'fwd_from' in msg else None, msg.get('fwd_date'), msg.get('reply_id'), msg['out'], msg['unread'], msg['service'], json.dumps(msg['action']) if 'action' in msg else None, msg['flags']))
-    logged.add(msg['id'])
+    global logcount
+    for peer in msgpeers(msg):
+        update_peer(peer)
+    conn.execute(MSG_SQL, msgrow(msg))
+    holes.add(msg['id'])
+    logcount += 1
 
 def init():
-    global logged
-    logged = set(i[0] for i in conn.execute('SELECT id FROM messages') if isinstance(i[0], int))
+    for i in conn.execute('SELECT id FROM messages ORDER BY id'):
+        if isinstance(i[0], int):
+            holes.add(i[0])
 
 def uniq(seq): # Dave Kirby
     # Order preserving
@@ -119,24 +157,30 @@ def rangedet(data):
         ranges.append((group[0], group[-1]))
     return ranges
 
-re_msglist = re.compile(r'^\[.+\]$')
+re_msglist = re.compile(r'^\[.*\]$')
 re_onemsg = re.compile(r'^\{.+\}$')
+# lineproc() of a message pushed by telegram-cli, not a reply
+PUSHED = 'pushed'
 
 def lineproc(ln):
+    '''
+    Logs the messages in a line of telegram-cli output. Returns True for
+    a history reply, False for a failed request, PUSHED for a single new
+    message and None for anything else.
+    '''
     ln = ln.strip()
     try:
         if re_msglist.match(ln):
-            ret = None
+            # also an empty history reply
             for msg in json.loads(ln):
                 if 'id' in msg and 'from' in msg and 'date' in msg:
                     log_msg(msg)
-                    ret = True
-            return ret
+            return True
         elif re_onemsg.match(ln):
             msg = json.loads(ln)
             if 'id' in msg and 'from' in msg and 'date' in msg:
                 log_msg(msg)
-                return True
+                return PUSHED
             elif msg.get('result') == "FAIL":
                 return False
     except Exception as ex:
@@ -144,30 +188,60 @@ def lineproc(ln):
         raise ex
 
 def file_input(filename):
-    global logged
-    with open(filename, 'r') as f:
+    '''
+    Bulk loads a telegram-cli JSON dump (a message or a list of them per
+    line) in one transaction.
+    '''
+    users, chats = {}, {}
+    def messages(f):
         for ln in f:
-            lineproc(ln)
-    db.commit()
+            try:
+                obj = json.loads(ln)
+            except ValueError:
+                continue
+            for msg in (obj if isinstance(obj, list) else (obj,)):
+                if isinstance(msg, dict) and 'id' in msg and 'from' in msg and 'date' in msg:
+                    for peer in msgpeers(msg):
+                        if peer['type'] == 'user':
+                            users[peer['id']] = peer
+                        elif peer['type'] == 'chat':
+                            chats[peer['id']] = peer
+                    holes.add(msg['id'])
+                    yield msgrow(msg)
+    start = time.perf_counter()
+    with open(filename, 'r') as f, sqlbulk.bulkmode(db, ('messages', 'users', 'chats')) as cur:
+        count = sqlbulk.executemany(cur, MSG_SQL, messages(f))
+        count += sqlbulk.executemany(cur, USER_SQL, map(userrow, users.values()))
+        count += sqlbulk.executemany(cur, CHAT_SQL, map(chatrow, chats.values()))
+    elapsed = time.perf_counter() - start
+    print('### Loaded %d rows in %.2fs, %.0f rows/s.' % (count, elapsed, count / elapsed))
 
-findholes = lambda: set(range(max(logged))).difference(logged)
-expandholes = lambda holes, n: set(itertools.chain.from_iterable(range(x-n, x+n+1) for x in holes))
-
-def generate_cmd(chatname):
-    for start, end in rangedet(sorted(expandholes(findholes(), 2))):
+def generate_cmd(chatname, pad=2):
+    '''
+    Yields history commands covering the current holes, each widened by
+    `pad`. Offsets count back from the newest message.
+    '''
+    maxid = holes.maxid
+    ranges = []
+    for start, end in list(holes):
+        start, end = max(start - pad, 1), end + pad
+        if ranges and start <= ranges[-1][1] + 1:
+            ranges[-1][1] = max(ranges[-1][1], end)
+        else:
+            ranges.append([start, end])
+    for start, end in ranges:
         chunk, rem = divmod(end - start + 1, 100)
         for i in range(chunk):
-            yield 'history %s 100 %s' % (chatname, max(max(logged) - (end - i * 100), 0))
-        yield 'history %s %s %s' % (chatname, rem, max(max(logged) - start, 0))
+            yield 'history %s 100 %s' % (chatname, max(maxid - (end - i * 100), 0))
+        if rem:
+            yield 'history %s %s %s' % (chatname, rem, max(maxid - (start + rem - 1), 0))
 
 proc = None
 
-def enqueue_output(queue):
+def enqueue_output(queue, tgcmd, cwd):
     global proc
-    tgdir = '/home/gumble/dev/tg'
-    #tgdir = '/home/gumble/github/tg'
     while 1:
-        proc = subprocess.Popen((os.path.join(tgdir, 'bin/telegram-cli'), '--json', '-RC'), stdin=subprocess.PIPE, stdout=subprocess.PIPE, cwd=tgdir)
+        proc = subprocess.Popen(tgcmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, cwd=cwd)
         try:
             for line in proc.stdout:
                 queue.put(line)
@@ -175,51 +249,98 @@ def enqueue_output(queue):
             continue
         finally:
             proc.terminate()
+        queue.put(None)
 
 
-def proc_input():
-    while len(findholes()) > 100:
+def waitidle(q, idle=2):
+    '''Prints the startup output of telegram-cli until it is quiet.'''
+    while 1:
         try:
-            q = queue.Queue()
-            t = threading.Thread(target=enqueue_output, args=(q,))
-            t.daemon = True # thread dies with the program
-            t.start()
-            print('### Launched telegram-cli. Max ID:', max(logged))
+            ln = q.get(timeout=idle)
+        except queue.Empty:
+            return
+        if ln:
+            print(ln.decode('utf-8', errors='replace').rstrip())
+
+
+def proc_input(tgcmd=TG_CMD, inflight=IN_FLIGHT, cwd=TG_DIR):
+    '''
+    Fills holes with up to `inflight` history requests outstanding.
+    Stops when a pass over all holes fills none of them.
+    '''
+    q = queue.Queue()
+    t = threading.Thread(target=enqueue_output, args=(q, tgcmd, cwd))
+    t.daemon = True # thread dies with the program
+    t.start()
+    waitidle(q)
+    print('### Launched telegram-cli. Max ID:', holes.maxid)
+    committed = logcount
+    try:
+        while len(holes):
+            before = len(holes)
+            print('### %d holes in %d ranges.' % (before, len(holes.starts)))
             cgen = generate_cmd(CHAT_NAME)
-            first = 1
-            failcount = 0
-            ln, ret = None, None
+            cmd, pending, started = None, 0, time.time()
             while 1:
+                while pending < inflight:
+                    cmd = cmd or next(cgen, None)
+                    if cmd is None:
+                        break
+                    try:
+                        proc.stdin.write((cmd + '\n').encode('utf-8'))
+                        proc.stdin.flush()
+                    except (BrokenPipeError, OSError, AttributeError):
+                        # restarted by enqueue_output, wait for it
+                        break
+                    print(cmd)
+                    cmd = None
+                    pending += 1
+                if not pending and cmd is None:
+                    break
                 try:
-                    ln = q.get_nowait() # or q.get(timeout=.1)
+                    ln = q.get(timeout=TIMEOUT)
                 except queue.Empty:
-                    time.sleep(2)
-                    failcount += 1
-                else: # got line
-                    # ... do something with line
-                    ln = ln.decode('utf-8').rstrip()
-                    ret = lineproc(ln)
-                if first and not ret:
+                    print('### Timed out, %d request(s) lost.' % pending)
+                    pending = 0
+                    continue
+                if ln is None:
+                    print('### telegram-cli died.')
+                    pending = 0
+                    waitidle(q)
+                    continue
+                ln = ln.decode('utf-8').rstrip()
+                ret = lineproc(ln)
+                if ret is None:
                     if ln:
                         print(ln)
-                elif (ln and (ln[0] == '[' or ret)) or failcount > 5:
-                    try:
-                        cmd = next(cgen)
-                    except StopIteration:
-                        continue
-                    print(cmd)
-                    proc.stdin.write((cmd + '\n').encode('utf-8'))
-                    if first:
-                        first = 0
-                    failcount = 0
-                    proc.stdin.flush()
-                elif ln:
-                    print(ln)
-            print('### telegram-cli died.')
-        finally:
+                elif ret is not PUSHED:
+                    # only replies free a request slot
+                    pending = max(pending - 1, 0)
+                if logcount - committed >= COMMIT_EVERY:
+                    db.commit()
+                    committed = logcount
             db.commit()
+            committed = logcount
+            print('### Filled %d holes in %.1fs.' % (before - len(holes), time.time() - started))
+            if len(holes) >= before:
+                break
+    finally:
+        db.commit()
+        if proc:
+            proc.terminate()
 
-init()
-#file_input(sys.argv[1])
-proc_input()
-#db.commit()
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    tgcmd, inflight, cwd = TG_CMD, IN_FLIGHT, TG_DIR
+    if '-j' in args:
+        inflight = int(args[args.index('-j') + 1])
+        del args[args.index('-j'):args.index('-j') + 2]
+    if '-c' in args:
+        # e.g. -c 'python3 vendor/faketgcli.py fixture.json'
+        tgcmd, cwd = shlex.split(args[args.index('-c') + 1]), None
+        del args[args.index('-c'):args.index('-c') + 2]
+    init()
+    if args:
+        file_input(args[0])
+    else:
+        proc_input(tgcmd, inflight, cwd)
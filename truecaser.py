@@ -19,18 +19,20 @@ def loaddict(fp):
             d[ln[0]] = ln[1]
     return d
 
-def train(iterable):
-    d = collections.defaultdict(collections.Counter)
+def count(iterable, d=None):
+    if d is None:
+        d = collections.defaultdict(collections.Counter)
     for ln in iterable:
         for tok in re_eng.split(ln):
             if 1 < len(tok) < 25 and re_eng.match(tok):
                 d[tok.lower()][tok] += 1
-    for word, val in tuple(d.items()):
-        if sum(val.values()) > 1:
-            d[word] = val.most_common(1)[0][0]
-        else:
-            del d[word]
-    return dict(d)
+    return d
+
+def bestcase(d):
+    return {word: val.most_common(1)[0][0] for word, val in d.items() if sum(val.values()) > 1}
+
+def train(iterable):
+    return bestcase(count(iterable))
 
 class Truecaser:
     def __init__(self, wmap):